@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Solves a whole directory of puzzles with a pool of processes.
+
+The dictionary is opened once in the parent and the workers are forked from
+it, so they share the mapped word index instead of receiving a copy per
+task. Results are written as JSON lines as soon as each puzzle is solved:
+`python3 batch.py puzzles/ > results.jsonl`
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import glob
+import io
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import instrument
+import solve
+from dictionary import open_dictionary
+from glyphs import load_templates
+
+
+def find_images(target):
+    """Returns the images of a directory, or the files matching a glob."""
+    if os.path.isdir(target):
+        target = os.path.join(target, "*.PNG")
+    return sorted(glob.glob(target))
+
+
+def count_board(board, lens, search="trie"):
+    """Counts the word sets of a parsed board and the orientations of each,
+    and returns the result as a dict that can be written as JSON.
+    """
+    start = time.perf_counter()
+    lens = sorted(lens, reverse=True)
+    word_to_location = solve.locate_words(board, lens, search)
+    counts = [{"words": word_list, "orientations": count}
+              for word_list, count in solve.count_iter(board, lens,
+                                                       word_to_location)]
+    return {"board": ["".join(row) for row in board],
+            "lens": lens,
+            "counts": counts,
+            "timings": {"solve": time.perf_counter() - start}}
+
+
+def solve_board(board, lens, search="trie", solver="dlx", limit=None):
+    """Solves a parsed board and returns the result as a dict that can be
+    written as JSON.
+    """
+    start = time.perf_counter()
+    solutions = []
+    with instrument.stage("solve"):
+        for word_list, paths in solve.solve_iter(board, lens, search, solver):
+            solutions.append({
+                "words": word_list,
+                "paths": [solve.decode_path(path, len(board[0]))
+                          for path in paths]})
+            if limit is not None and len(solutions) >= limit:
+                break
+
+    return {"board": ["".join(row) for row in board],
+            "lens": sorted(lens, reverse=True),
+            "solutions": solutions,
+            "timings": {"solve": time.perf_counter() - start}}
+
+
+def solve_file(name, search="trie", solver="dlx", limit=None, cache=True,
+               glyphs=solve.GLYPHS, count=False):
+    """Parses and solves one image, given as a file name or a file object,
+    and returns the result as a dict that can be written as JSON. Parsed
+    boards are looked up in the board cache unless cache is False. With
+    count, the word sets are only counted, see count_board. With the
+    instrumentation on, the result has the profile report of the puzzle.
+    """
+    instrument.reset()
+    try:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            if cache:
+                board, pixel_to_rc, lens = solve.get_cached_input(
+                    name, glyphs=glyphs)
+            else:
+                board, pixel_to_rc, lens = solve.get_input(name, glyphs)
+        parsed = time.perf_counter()
+        if count:
+            result = count_board(board, lens, search)
+        else:
+            result = solve_board(board, lens, search, solver, limit)
+    except Exception as e:
+        return {"name": str(name), "error": "%s: %s" % (type(e).__name__, e)}
+
+    result["timings"]["parse"] = parsed - start
+    if instrument.enabled:
+        result["profile"] = instrument.report()
+    return dict(name=str(name), **result)
+
+
+def solve_batch(names, workers=None, search="trie", solver="dlx",
+                limit=None, cache=True, glyphs=solve.GLYPHS, count=False):
+    """Yields the result of every image as soon as a worker finishes it."""
+    open_dictionary()
+    load_templates()
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+    else:
+        context = None
+
+    with concurrent.futures.ProcessPoolExecutor(workers, context) as pool:
+        futures = [pool.submit(solve_file, name, search, solver, limit, cache,
+                               glyphs, count)
+                   for name in names]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("target", help="directory of images or a glob, "
+                        "e.g. puzzles/ or 'puzzles/IMG_1*.PNG'")
+    parser.add_argument("--workers", type=int,
+                        help="number of processes (default: one per core)")
+    parser.add_argument("--search", choices=("trie", "word"), default="trie")
+    parser.add_argument("--solver", choices=("search", "dlx", "adaptive"),
+                        default="dlx")
+    parser.add_argument("--limit", type=int, metavar="N",
+                        help="keep at most N solutions per puzzle")
+    parser.add_argument("--count", action="store_true",
+                        help="only count the word sets of each puzzle and "
+                        "the orientations of each set")
+    parser.add_argument("--glyphs", choices=("template", "rules"),
+                        default=solve.GLYPHS,
+                        help="how the letters are read from the bubbles")
+    parser.add_argument("--profile", action="store_true",
+                        help="add the stage timings and search counters of "
+                        "each puzzle to its result")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="always parse the images instead of looking "
+                        "the boards up in the board cache")
+    args = parser.parse_args()
+
+    if args.profile:
+        instrument.enable(memory=False)
+    start = time.perf_counter()
+    names = find_images(args.target)
+    for result in solve_batch(names, args.workers, args.search, args.solver,
+                              args.limit, not args.no_cache, args.glyphs,
+                              args.count):
+        sys.stdout.write(json.dumps(result) + "\n")
+        sys.stdout.flush()
+
+    print("Solved %d puzzles in %.2f seconds" %
+          (len(names), time.perf_counter() - start), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,522 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Benchmarks the solver on the puzzles/ corpus.
+
+Run this to compare the get_letter rules with the glyph templates, the
+per-word DFS with the DAWG board search, and the backtracking solver with
+the Dancing Links and the adaptive solvers, and to count the search nodes
+each solver visits:
+`python3 benchmark.py`
+
+With --stages every stage of every puzzle is timed on its own instead, and
+the boards, lengths and solutions are recorded. The report can be written
+as JSON and checked against a stored baseline, which flags stages that got
+slower and any change in the boards or the solutions:
+`python3 benchmark.py --stages --baseline benchmark_baseline.json`
+`python3 benchmark.py --stages --json benchmark_baseline.json`
+
+Both also measure the cold start of solve.py with python -X importtime.
+"""
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+import glyphs
+import instrument
+import solve
+
+
+def load_puzzles(pattern="puzzles/*.PNG"):
+    """Parses every image matching the pattern and returns a list of
+    (name, board, lens) triples.
+    """
+    puzzles = []
+    for name in sorted(glob.glob(pattern)):
+        with contextlib.redirect_stdout(io.StringIO()):
+            board, pixel_to_rc, lens = solve.get_input(name)
+        puzzles.append((os.path.splitext(os.path.basename(name))[0],
+                        board, lens))
+    return puzzles
+
+
+def time_runs(function, repeat):
+    """Calls function repeat times and returns the median time in seconds
+    along with the result of the last call.
+    """
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), result
+
+
+def time_stage(function, repeat):
+    """Calls function repeat times and returns the median and the spread
+    (slowest minus fastest) of the times in seconds, along with the result
+    of the last call.
+    """
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return ({"median": statistics.median(times),
+             "spread": max(times) - min(times)}, result)
+
+
+# The stages of bench_stages, in the order they run.
+STAGES = ("classify", "layout", "glyphs", "triplet_prune", "find_word",
+          "find_words", "frequency_pruning", "non_overlapping_solution",
+          "dlx", "adaptive")
+
+
+def bench_stages(name, repeat):
+    """Runs one image through every stage, each on the output of the one
+    before, and returns its board, lengths, solutions and the timings of
+    each stage.
+    """
+    stages = {}
+    stages["classify"], (pixels, areas) = time_stage(
+        lambda: solve.classify_image(Image.open(name)), repeat)
+    # find_layout paints the bubbles, so every run gets its own copy.
+    with contextlib.redirect_stdout(io.StringIO()):
+        stages["layout"], (bubble_box, strokes, lens) = time_stage(
+            lambda: solve.find_layout(pixels.copy(), areas), repeat)
+        solve.find_layout(pixels, areas)
+    counts = solve.black_counts(pixels, bubble_box)
+    stages["glyphs"], letters = time_stage(
+        lambda: solve.read_letters(pixels, bubble_box, strokes, counts),
+        repeat)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        board, pixel_to_rc, lens = solve.get_input(name)
+    lens = sorted(lens, reverse=True)
+
+    stages["triplet_prune"], words = time_stage(
+        lambda: solve.triplet_prune(board, lens), repeat)
+    stages["find_word"], expected = time_stage(
+        lambda: word_search(board, words), repeat)
+    stages["find_words"], word_to_location = time_stage(
+        lambda: trie_search(board, words), repeat)
+    stages["frequency_pruning"], word_lists = time_stage(
+        lambda: list(solve.word_sets(board, lens, word_to_location)),
+        repeat)
+    word_to_masks = solve.get_mask_map(word_to_location)
+    stages["non_overlapping_solution"], placements = time_stage(
+        lambda: [solve.place_words(word_list, word_to_location,
+                                   word_to_masks)
+                 for word_list in word_lists],
+        repeat)
+    stages["dlx"], found = time_stage(
+        lambda: solve.dlx_solution(board, lens, word_to_location), repeat)
+    stages["adaptive"], adapted = time_stage(
+        lambda: solve.adaptive_solution(board, lens, word_to_location),
+        repeat)
+
+    solutions = [{"words": word_list, "placements": len(paths)}
+                 for word_list, paths in zip(word_lists, placements) if paths]
+    problems = []
+    if expected != word_to_location:
+        problems.append("find_word and find_words found different words")
+    if list(found) != [str(solution["words"]) for solution in solutions]:
+        problems.append("dlx found different solutions")
+    if adapted != found:
+        problems.append("adaptive found different solutions")
+
+    return {"board": ["".join(row) for row in board],
+            "lens": lens,
+            "solutions": solutions,
+            "problems": problems,
+            "stages": stages}
+
+
+def import_times(args):
+    """Runs python -X importtime with args in a fresh process and returns
+    the cumulative import time in seconds and the nesting depth of every
+    module it imported, along with the wall time of the whole process.
+    """
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime"] + args,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+    wall = time.perf_counter() - start
+
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_time, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules[name.strip()] = (int(cumulative) / 1e6, depth)
+    return modules, wall
+
+
+def measure_startup(board, lens, repeat):
+    """Measures the cold start with -X importtime: the time to import solve
+    and its slowest imports, and the time of a whole solve.py process that
+    solves the given board from JSON, which must not import PIL.
+    """
+    imports = []
+    for i in range(repeat):
+        modules, wall = import_times(["-c", "import solve"])
+        imports.append(modules)
+    # The modules solve imports itself are one level below it.
+    depth = imports[-1]["solve"][1] + 1
+    slowest = sorted((seconds, name) for name, (seconds, level)
+                     in imports[-1].items() if level == depth)[::-1]
+
+    with tempfile.NamedTemporaryFile("w", suffix=".json",
+                                     delete=False) as f:
+        json.dump({"board": board, "lens": lens}, f)
+    try:
+        walls = []
+        for i in range(repeat):
+            modules, wall = import_times(["solve.py", "--board", f.name])
+            walls.append(wall)
+    finally:
+        os.unlink(f.name)
+
+    return {"import_solve": statistics.median(
+                modules["solve"][0] for modules in imports),
+            "slowest_imports": {name: seconds
+                                for seconds, name in slowest[:5]},
+            "board_process": statistics.median(walls),
+            "board_imports_pil": any(name == "PIL" or name.startswith("PIL.")
+                                     for name in modules)}
+
+
+def print_startup(startup):
+    """Prints the measure_startup results in ms."""
+    print("import solve: %.1f ms (slowest: %s)" % (
+        startup["import_solve"] * 1000,
+        ", ".join("%s %.1f ms" % (name, seconds * 1000)
+                  for name, seconds in startup["slowest_imports"].items())))
+    print("solve.py --board process: %.1f ms, %s" % (
+        startup["board_process"] * 1000,
+        "imports PIL" if startup["board_imports_pil"] else "no PIL"))
+
+
+def run_stages(pattern, repeat):
+    """Returns the bench_stages report of every image matching the pattern,
+    with the total median time of each stage.
+    """
+    # Load the templates up front so the first puzzle does not pay for it.
+    glyphs.load_templates()
+    puzzles = {}
+    for name in sorted(glob.glob(pattern)):
+        puzzles[os.path.splitext(os.path.basename(name))[0]] = \
+            bench_stages(name, repeat)
+
+    totals = {stage: sum(puzzle["stages"][stage]["median"]
+                         for puzzle in puzzles.values())
+              for stage in STAGES}
+    report = {"repeat": repeat, "puzzles": puzzles, "totals": totals}
+    if puzzles:
+        first = next(iter(puzzles.values()))
+        report["startup"] = measure_startup(first["board"], first["lens"],
+                                            repeat)
+    return report
+
+
+def print_stages(report):
+    """Prints the median time of every stage of every puzzle in ms."""
+    names = [stage[:10] for stage in STAGES]
+    print("%-8s" % "puzzle" + "".join(" %10s" % name for name in names))
+    for name, puzzle in report["puzzles"].items():
+        print("%-8s" % name + "".join(
+            " %10.2f" % (puzzle["stages"][stage]["median"] * 1000)
+            for stage in STAGES))
+        for problem in puzzle["problems"]:
+            print("%s: %s" % (name, problem))
+    print("%-8s" % "total" + "".join(
+        " %10.2f" % (report["totals"][stage] * 1000) for stage in STAGES))
+    if "startup" in report:
+        print()
+        print_startup(report["startup"])
+
+
+def compare_reports(report, baseline, tolerance=0.25, floor=0.002):
+    """Returns a list of the differences that matter between a report and a
+    baseline: puzzles whose board, lengths or solutions changed, and stages
+    whose median grew by more than tolerance times the baseline and by more
+    than floor seconds. Stages of a few ms would be flagged by noise alone
+    without the floor.
+    """
+    problems = []
+    for name, puzzle in report["puzzles"].items():
+        if name not in baseline["puzzles"]:
+            problems.append("%s: not in the baseline" % name)
+            continue
+        old = baseline["puzzles"][name]
+        for key in ("board", "lens", "solutions"):
+            if puzzle[key] != old[key]:
+                problems.append("%s: the %s changed" % (name, key))
+        for problem in puzzle["problems"]:
+            problems.append("%s: %s" % (name, problem))
+        for stage in STAGES:
+            if stage not in old["stages"]:
+                continue
+            now = puzzle["stages"][stage]["median"]
+            then = old["stages"][stage]["median"]
+            if now > then * (1 + tolerance) and now - then > floor:
+                problems.append("%s: %s took %.2f ms instead of %.2f ms" %
+                                (name, stage, now * 1000, then * 1000))
+    if "startup" in report:
+        startup = report["startup"]
+        if startup["board_imports_pil"]:
+            problems.append("startup: solve.py --board imports PIL")
+        for key in ("import_solve", "board_process"):
+            if key not in baseline.get("startup", {}):
+                continue
+            now = startup[key]
+            then = baseline["startup"][key]
+            # Process start times are noisy, so the floor is larger.
+            if now > then * (1 + tolerance) and now - then > 10 * floor:
+                problems.append("startup: %s took %.1f ms instead of %.1f ms"
+                                % (key, now * 1000, then * 1000))
+    return problems
+
+
+def word_search(board, words):
+    """Locates the words with one find_word call each."""
+    word_to_location = {}
+    neighbors = solve.get_neighbors(board)
+    for word in words:
+        solve.find_word(board, word, word_to_location, neighbors)
+    return word_to_location
+
+
+def trie_search(board, words):
+    """Locates the words with a single DAWG walk of the board."""
+    word_to_location = {}
+    solve.find_words(board, words, word_to_location)
+    return word_to_location
+
+
+def bench_glyphs(pattern, repeat):
+    """Checks the glyph templates against the letters the get_letter rules
+    read, both with the stored templates and with templates rebuilt without
+    each puzzle, and times reading all bubbles both ways.
+    """
+    samples = {}
+    for name in sorted(glob.glob(pattern)):
+        with contextlib.redirect_stdout(io.StringIO()):
+            samples[name] = solve.get_glyph_samples(name)
+    stored = glyphs.load_templates()
+    if stored is None:
+        print("no glyph templates, run python3 glyphs.py")
+        return
+
+    wrong = [0, 0]
+    total = 0
+    for name in samples:
+        labels = [letter for letter, feature in samples[name]]
+        features = np.stack([feature for letter, feature in samples[name]])
+        found = glyphs.classify_glyphs(features, *stored)[0]
+        wrong[0] += sum(a != b for a, b in zip(found, labels))
+
+        others = [(letter, feature) for other in samples if other != name
+                  for letter, feature in samples[other]]
+        letters, templates = glyphs.make_templates(
+            np.stack([feature for letter, feature in others]),
+            [letter for letter, feature in others])
+        found = glyphs.classify_glyphs(features, letters, templates)[0]
+        wrong[1] += sum(a != b for a, b in zip(found, labels))
+        total += len(labels)
+
+    print("%d glyphs, %d misread by the stored templates, %d with each "
+          "puzzle left out of the templates" % (total, wrong[0], wrong[1]))
+
+    # Time only the letter reading, from the parsed strokes onwards.
+    parsed = []
+    for name in samples:
+        with contextlib.redirect_stdout(io.StringIO()):
+            pixels, bubble_box, strokes, lens = solve.parse_image(name)
+        parsed.append((pixels, bubble_box, strokes,
+                       solve.black_counts(pixels, bubble_box)))
+    rules_time, result = time_runs(lambda: [solve.read_letters(
+        *args, glyphs="rules") for args in parsed], repeat)
+    template_time, result = time_runs(lambda: [solve.read_letters(
+        *args, glyphs="template") for args in parsed], repeat)
+    print("read %d glyphs in %.4f s with the rules, %.4f s with the "
+          "templates (%.1fx)" % (total, rules_time, template_time,
+                                 rules_time / template_time))
+
+
+def bench_search(puzzles, repeat):
+    """Times triplet_prune followed by each word search on every puzzle and
+    checks that both searches find the same words in the same places.
+    """
+    print("%-8s %8s %10s %10s %10s %8s" % ("puzzle", "words", "prune (s)",
+                                           "word (s)", "trie (s)",
+                                           "speedup"))
+    totals = [0, 0, 0]
+    for name, board, lens in puzzles:
+        prune_time, words = time_runs(
+            lambda: solve.triplet_prune(board, lens), repeat)
+        word_time, expected = time_runs(lambda: word_search(board, words),
+                                        repeat)
+        trie_time, found = time_runs(lambda: trie_search(board, words),
+                                     repeat)
+        if found != expected:
+            print("%s: the trie search found different words" % name)
+        totals[0] += prune_time
+        totals[1] += word_time
+        totals[2] += trie_time
+        print("%-8s %8d %10.4f %10.4f %10.4f %7.1fx" % (
+            name, len(found), prune_time, word_time, trie_time,
+            word_time / trie_time))
+
+    print("%-8s %8s %10.4f %10.4f %10.4f %7.1fx" % (
+        "total", "", totals[0], totals[1], totals[2],
+        totals[1] / totals[2]))
+
+
+def bench_solvers(puzzles, repeat):
+    """Times the backtracking search, the Dancing Links solver and the
+    adaptive solver on every puzzle and checks that they find the same
+    solutions. The speedups are of each solver over the search.
+    """
+    print("%-8s %8s %10s %10s %8s %12s %8s" % (
+        "puzzle", "sets", "search (s)", "dlx (s)", "speedup",
+        "adaptive (s)", "speedup"))
+    totals = [0, 0, 0]
+    for name, board, lens in puzzles:
+        lens = sorted(lens, reverse=True)
+        word_to_location = trie_search(board, solve.triplet_prune(board, lens))
+        search_time, expected = time_runs(
+            lambda: solve.search_solution(board, lens, word_to_location),
+            repeat)
+        dlx_time, found = time_runs(
+            lambda: solve.dlx_solution(board, lens, word_to_location), repeat)
+        adaptive_time, adapted = time_runs(
+            lambda: solve.adaptive_solution(board, lens, word_to_location),
+            repeat)
+        if found != expected:
+            print("%s: the dlx solver found different solutions" % name)
+        if adapted != expected:
+            print("%s: the adaptive solver found different solutions" % name)
+        totals[0] += search_time
+        totals[1] += dlx_time
+        totals[2] += adaptive_time
+        print("%-8s %8d %10.4f %10.4f %7.1fx %12.4f %7.1fx" % (
+            name, len(found), search_time, dlx_time, search_time / dlx_time,
+            adaptive_time, search_time / adaptive_time))
+
+    print("%-8s %8s %10.4f %10.4f %7.1fx %12.4f %7.1fx" % (
+        "total", "", totals[0], totals[1], totals[0] / totals[1],
+        totals[2], totals[0] / totals[2]))
+
+
+# The counters of the nodes each solver visits, see instrument.
+NODE_COUNTERS = {
+    "search": ("frequency_pruning.nodes", "non_overlapping_solution.nodes"),
+    "dlx": ("dlx.nodes",),
+    "adaptive": ("adaptive.nodes",),
+}
+
+
+def bench_nodes(puzzles):
+    """Counts the search nodes each solver visits on every puzzle. The
+    search counts the nodes of frequency_pruning and of placing each word
+    set.
+    """
+    print("%-8s %10s %10s %10s" % ("puzzle", "search", "dlx", "adaptive"))
+    was_enabled = instrument.enabled
+    instrument.enabled = True
+    totals = dict.fromkeys(NODE_COUNTERS, 0)
+    try:
+        for name, board, lens in puzzles:
+            lens = sorted(lens, reverse=True)
+            word_to_location = trie_search(board,
+                                           solve.triplet_prune(board, lens))
+            nodes = {}
+            for solver, counters in NODE_COUNTERS.items():
+                instrument.reset()
+                for solution in solve.solution_iter(board, lens,
+                                                    word_to_location, solver):
+                    pass
+                found = instrument.report()["counters"]
+                nodes[solver] = sum(sum(found.get(counter, []))
+                                    for counter in counters)
+                totals[solver] += nodes[solver]
+            print("%-8s %10d %10d %10d" % (
+                name, nodes["search"], nodes["dlx"], nodes["adaptive"]))
+    finally:
+        instrument.enabled = was_enabled
+        instrument.reset()
+
+    print("%-8s %10d %10d %10d" % (
+        "total", totals["search"], totals["dlx"], totals["adaptive"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pattern", default="puzzles/*.PNG",
+                        help="glob of the images to benchmark")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="number of timed runs per measurement")
+    parser.add_argument("--stages", action="store_true",
+                        help="time every stage of every puzzle and record "
+                        "the boards and solutions")
+    parser.add_argument("--json", metavar="FILE",
+                        help="write the --stages report to FILE")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="compare the --stages report to FILE and exit "
+                        "with status 1 on any regression")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown of a stage against the "
+                        "baseline, as a fraction (default: 0.25)")
+    args = parser.parse_args()
+
+    if args.stages:
+        report = run_stages(args.pattern, args.repeat)
+        print_stages(report)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=1)
+                f.write("\n")
+        if args.baseline:
+            with open(args.baseline) as f:
+                problems = compare_reports(report, json.load(f),
+                                           args.tolerance)
+            print()
+            for problem in problems:
+                print(problem)
+            print("%d regressions against %s" % (len(problems),
+                                                 args.baseline))
+            if problems:
+                sys.exit(1)
+        return
+
+    bench_glyphs(args.pattern, args.repeat)
+    print()
+    puzzles = load_puzzles(args.pattern)
+    bench_search(puzzles, args.repeat)
+    print()
+    bench_solvers(puzzles, args.repeat)
+    print()
+    bench_nodes(puzzles)
+    if puzzles:
+        name, board, lens = puzzles[0]
+        print()
+        print_startup(measure_startup(["".join(row) for row in board], lens,
+                                      args.repeat))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Compiled binary form of the word list.
+
+The text dictionary is compiled once into a file next to it (allWords.txt
+becomes allWords.bin) that holds the words bucketed by length, every word's
+26-letter count vector, every word's trigrams encoded as ints and a checksum
+of the source text. The file is opened
+with mmap, so only the length buckets a puzzle asks for are ever paged in.
+"""
+
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+import numpy as np
+
+
+MAGIC = b"WPDICT"
+VERSION = 2
+
+# magic, version, crc32 of the source, source size, source mtime, buckets
+HEADER = struct.Struct("<6sHIQQI")
+# word length, word count, offset of the letters, offset of the counts. The
+# trigrams follow the counts.
+BUCKET = struct.Struct("<IIQQ")
+
+
+def cache_name(name):
+    """Returns the name of the compiled file for a text dictionary."""
+    return os.path.splitext(name)[0] + ".bin"
+
+
+def letter_counts(codes):
+    """Turns an (n, length) array of letter codes 0-25 into an (n, 26)
+    array holding how many times each letter appears in each word.
+    """
+    counts = np.zeros((len(codes), 26), dtype=np.uint8)
+    rows = np.arange(len(codes))
+    for k in range(codes.shape[1]):
+        counts[rows, codes[:, k]] += 1
+    return counts
+
+
+def trigram_codes(codes):
+    """Turns an (n, length) array of letter codes 0-25 into an
+    (n, length - 2) array of the trigrams of each word, each encoded as
+    a * 26 * 26 + b * 26 + c.
+    """
+    codes = codes.astype(np.uint16)
+    return codes[:, :-2] * 676 + codes[:, 1:-1] * 26 + codes[:, 2:]
+
+
+def read_chunks(name, chunk_size=1 << 20):
+    """Yields the bytes of a file in chunks of chunk_size bytes, so the
+    whole file is never held in memory.
+    """
+    with open(name, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def read_words(name, chunk_size=1 << 20):
+    """Yields the upper-cased words of a text file as bytes, reading it in
+    chunks of chunk_size bytes.
+    """
+    rest = b""
+    for chunk in read_chunks(name, chunk_size):
+        words = (rest + chunk).split()
+        # The last word may go on in the next chunk.
+        rest = words.pop() if words and not chunk[-1:].isspace() else b""
+        for word in words:
+            yield word.upper()
+    if rest:
+        yield rest.upper()
+
+
+def file_crc(name):
+    """Returns the crc32 of a file."""
+    crc = 0
+    for chunk in read_chunks(name):
+        crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def compile_dictionary(name="allWords.txt", cache=None):
+    """Compiles the text dictionary into its binary form. Words keep their
+    order from the text file inside each length bucket. Words with anything
+    but the letters A-Z, such as "don't" or "cafe" with an accent, cannot
+    be on a board and are skipped, with a note on stderr.
+    """
+    if cache is None:
+        cache = cache_name(name)
+
+    stat = os.stat(name)
+    buckets = {}
+    skipped = 0
+    for word in read_words(name):
+        # bytes.isalpha is true for the ASCII letters only.
+        if not word.isalpha():
+            skipped += 1
+            continue
+        if len(word) not in buckets:
+            buckets[len(word)] = []
+        buckets[len(word)].append(word)
+    if skipped:
+        print("%s: skipped %d words that are not made of the letters A-Z "
+              "only" % (name, skipped), file=sys.stderr)
+
+    lengths = sorted(buckets)
+    offset = HEADER.size + BUCKET.size * len(lengths)
+    table = []
+    blobs = []
+    for length in lengths:
+        letters = b"".join(buckets[length])
+        codes = np.frombuffer(letters, dtype=np.uint8).reshape(-1, length)
+        counts = letter_counts(codes - ord("A")).tobytes()
+        trigrams = trigram_codes(codes - ord("A")).astype("<u2").tobytes()
+        table.append(BUCKET.pack(length, len(codes), offset,
+                                 offset + len(letters)))
+        blobs.append(letters)
+        blobs.append(counts)
+        blobs.append(trigrams)
+        offset += len(letters) + len(counts) + len(trigrams)
+
+    # Write to a temporary file first so a reader never sees half a file.
+    temp = cache + ".tmp"
+    with open(temp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, file_crc(name), stat.st_size,
+                            stat.st_mtime_ns, len(lengths)))
+        f.writelines(table)
+        f.writelines(blobs)
+    os.replace(temp, cache)
+
+
+def is_fresh(name, cache):
+    """Checks if the compiled file exists and matches the text dictionary.
+    The size and modification time are compared first, and the checksum is
+    only computed when they differ.
+    """
+    try:
+        with open(cache, "rb") as f:
+            header = f.read(HEADER.size)
+    except OSError:
+        return False
+
+    if len(header) != HEADER.size:
+        return False
+    magic, version, crc, size, mtime, count = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        return False
+
+    stat = os.stat(name)
+    if stat.st_size == size and stat.st_mtime_ns == mtime:
+        return True
+
+    return file_crc(name) == crc
+
+
+class Dictionary:
+    """A read-only view of a compiled dictionary. It is rebuilt first if it
+    is missing or older than the text it was compiled from.
+    """
+
+    def __init__(self, name="allWords.txt"):
+        cache = cache_name(name)
+        if not is_fresh(name, cache):
+            compile_dictionary(name, cache)
+
+        with open(cache, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        count = HEADER.unpack_from(self.data)[5]
+        self.buckets = {}
+        for i in range(count):
+            bucket = BUCKET.unpack_from(self.data,
+                                        HEADER.size + BUCKET.size * i)
+            self.buckets[bucket[0]] = bucket[1:]
+
+    def lengths(self):
+        """Returns the word lengths present in the dictionary."""
+        return sorted(self.buckets)
+
+    def letters(self, length):
+        """Returns the words of a length as an (n, length) array of ASCII
+        codes backed by the mapped file.
+        """
+        if length not in self.buckets:
+            return np.zeros((0, length), dtype=np.uint8)
+        count, start, end = self.buckets[length]
+        return np.frombuffer(self.data, dtype=np.uint8, count=count * length,
+                             offset=start).reshape(count, length)
+
+    def counts(self, length):
+        """Returns the (n, 26) letter count vectors of the words of a
+        length.
+        """
+        if length not in self.buckets:
+            return np.zeros((0, 26), dtype=np.uint8)
+        count, start, end = self.buckets[length]
+        return np.frombuffer(self.data, dtype=np.uint8, count=count * 26,
+                             offset=end).reshape(count, 26)
+
+    def trigrams(self, length):
+        """Returns the (n, length - 2) encoded trigrams of the words of a
+        length, see trigram_codes.
+        """
+        width = max(length - 2, 0)
+        if length not in self.buckets:
+            return np.zeros((0, width), dtype="<u2")
+        count, start, end = self.buckets[length]
+        return np.frombuffer(self.data, dtype="<u2", count=count * width,
+                             offset=end + count * 26).reshape(count, width)
+
+    def words(self, length, rows=None):
+        """Returns the words of a length as a list of strings, or only the
+        words at the given rows of the bucket.
+        """
+        if length not in self.buckets:
+            return []
+        if rows is not None:
+            text = self.letters(length)[rows].tobytes().decode("ascii")
+        else:
+            count, start, end = self.buckets[length]
+            text = self.data[start:start + count * length].decode("ascii")
+        return [text[i:i + length] for i in range(0, len(text), length)]
+
+
+_dictionaries = {}
+
+
+def open_dictionary(name="allWords.txt"):
+    """Returns the compiled dictionary for a text file, opening it only once
+    per process.
+    """
+    if name not in _dictionaries:
+        _dictionaries[name] = Dictionary(name)
+    return _dictionaries[name]
+
+
+if __name__ == '__main__':
+    name = sys.argv[1] if len(sys.argv) > 1 else "allWords.txt"
+    compile_dictionary(name)
+    print("Compiled %s into %s" % (name, cache_name(name)))
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Knuth's Dancing Links (Algorithm X) for exact cover problems.
+
+Besides the usual primary columns, which every solution covers exactly
+once, there are secondary columns, which are covered at most once, and
+counter columns, which must be covered by exactly `need` rows.
+"""
+
+import instrument
+
+
+class ExactCover:
+    """An exact cover problem stored as a toroidal doubly linked list in
+    flat arrays. Node 0 is the root, nodes 1 to n are the column headers and
+    the remaining nodes belong to the rows.
+    """
+
+    def __init__(self, primary, secondary=(), counters=None):
+        """primary and secondary are lists of column names. counters maps a
+        column name to the number of rows that must cover it.
+        """
+        if counters is None:
+            counters = {}
+
+        self.names = list(primary) + list(secondary) + list(counters)
+        self.index = {name: i + 1 for i, name in enumerate(self.names)}
+        count = len(self.names)
+
+        self.left = [0] * (count + 1)
+        self.right = [0] * (count + 1)
+        self.up = list(range(count + 1))
+        self.down = list(range(count + 1))
+        self.column = list(range(count + 1))
+        self.size = [0] * (count + 1)
+        self.row = [None] * (count + 1)
+        self.need = [0] * (count + 1)
+
+        # Only primary columns are linked into the header list, so they are
+        # the only ones the search has to cover.
+        previous = 0
+        for i in range(1, len(primary) + 1):
+            self.left[i] = previous
+            self.right[previous] = i
+            previous = i
+        self.left[0] = previous
+        self.right[previous] = 0
+        for i in range(len(primary) + 1, count + 1):
+            self.left[i] = i
+            self.right[i] = i
+
+        for name in counters:
+            self.need[self.index[name]] = counters[name]
+        self.counter = set(self.index[name] for name in counters)
+
+    def add_row(self, columns, row):
+        """Adds a row that covers the named columns. row is the value handed
+        back in solutions.
+        """
+        first = None
+        for name in columns:
+            c = self.index[name]
+            node = len(self.column)
+            self.column.append(c)
+            self.row.append(row)
+            self.size[c] += 1
+
+            self.up.append(self.up[c])
+            self.down.append(c)
+            self.down[self.up[c]] = node
+            self.up[c] = node
+
+            if first is None:
+                first = node
+                self.left.append(node)
+                self.right.append(node)
+            else:
+                self.left.append(self.left[first])
+                self.right.append(first)
+                self.right[self.left[first]] = node
+                self.left[first] = node
+
+    def cover(self, c):
+        """Removes column c and every row that uses it."""
+        left, right, up, down = self.left, self.right, self.up, self.down
+        right[left[c]] = right[c]
+        left[right[c]] = left[c]
+        i = down[c]
+        while i != c:
+            j = right[i]
+            while j != i:
+                down[up[j]] = down[j]
+                up[down[j]] = up[j]
+                self.size[self.column[j]] -= 1
+                j = right[j]
+            i = down[i]
+
+    def uncover(self, c):
+        """Puts back what cover(c) removed, in reverse order."""
+        left, right, up, down = self.left, self.right, self.up, self.down
+        i = up[c]
+        while i != c:
+            j = left[i]
+            while j != i:
+                self.size[self.column[j]] += 1
+                down[up[j]] = j
+                up[down[j]] = j
+                j = left[j]
+            i = up[i]
+        right[left[c]] = c
+        left[right[c]] = c
+
+    def choose(self):
+        """Returns the primary column with the fewest rows left."""
+        best = 0
+        c = self.right[0]
+        while c != 0:
+            if best == 0 or self.size[c] < self.size[best]:
+                best = c
+                if self.size[c] <= 1:
+                    break
+            c = self.right[c]
+        return best
+
+    def select(self, node):
+        """Covers every other column of the row of node. A counter column
+        is covered only once its last needed row is taken.
+        """
+        j = self.right[node]
+        while j != node:
+            c = self.column[j]
+            if c in self.counter:
+                self.need[c] -= 1
+                if self.need[c] == 0:
+                    self.cover(c)
+            else:
+                self.cover(c)
+            j = self.right[j]
+
+    def deselect(self, node):
+        """Undoes select(node)."""
+        j = self.left[node]
+        while j != node:
+            c = self.column[j]
+            if c in self.counter:
+                if self.need[c] == 0:
+                    self.uncover(c)
+                self.need[c] += 1
+            else:
+                self.uncover(c)
+            j = self.left[j]
+
+    def solve(self, partial=None):
+        """Yields every exact cover as a list of rows."""
+        if partial is None:
+            partial = []
+
+        if instrument.enabled:
+            instrument.count("dlx.nodes", len(partial))
+        if self.right[0] == 0:
+            if all(self.need[c] == 0 for c in self.counter):
+                yield list(partial)
+            return
+
+        c = self.choose()
+        if self.size[c] == 0:
+            if instrument.enabled:
+                instrument.count("dlx.dead_ends", len(partial))
+            return
+
+        self.cover(c)
+        i = self.down[c]
+        while i != c:
+            partial.append(self.row[i])
+            self.select(i)
+            yield from self.solve(partial)
+            self.deselect(i)
+            partial.pop()
+            i = self.down[i]
+        self.uncover(c)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Template matching for the letters in the bubbles.
+
+Every glyph is cut out as a square around its black strokes and averaged
+down to a GRID x GRID feature vector. All bubbles of a puzzle are then
+classified together by their distance to one reference template per letter.
+The templates are the mean glyph of each letter over the puzzles/ images,
+labelled by the get_letter rules, and are stored in glyphs.json. Rebuild
+them with:
+`python3 glyphs.py`
+"""
+
+import json
+import os
+
+import numpy as np
+
+
+GRID = 16
+TEMPLATE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "glyphs.json")
+
+
+def glyph_features(pixels, glyph_boxes, black=0):
+    """Turns every ((x3, y3), (x4, y4)) glyph box of the [x, y] label array
+    into a row of GRID * GRID black pixel fractions. The box is widened to a
+    square around its centre first, so letters keep their aspect ratio.
+    """
+    features = np.zeros((len(glyph_boxes), GRID * GRID), dtype=np.float32)
+    for k, ((x3, y3), (x4, y4)) in enumerate(glyph_boxes):
+        side = max(x4 - x3, y4 - y3) + 1
+        if side <= 0:
+            continue
+        x0 = (x3 + x4 + 1 - side) // 2
+        y0 = (y3 + y4 + 1 - side) // 2
+
+        square = np.zeros((side, side), dtype=np.float32)
+        sx = max(x0, 0)
+        sy = max(y0, 0)
+        ex = min(x0 + side, pixels.shape[0])
+        ey = min(y0 + side, pixels.shape[1])
+        square[sy - y0:ey - y0, sx - x0:ex - x0] = \
+            (pixels[sx:ex, sy:ey] == black).T
+
+        # Average over GRID x GRID blocks. A glyph smaller than the grid
+        # gets blocks of one pixel, repeated.
+        start = (np.arange(GRID) * side) // GRID
+        end = np.maximum(((np.arange(GRID) + 1) * side) // GRID, start + 1)
+        total = np.add.reduceat(np.add.reduceat(square, start, axis=0),
+                                start, axis=1)
+        area = np.outer(end - start, end - start)
+        features[k] = (total / area).ravel()
+
+    return features
+
+
+def make_templates(features, labels):
+    """Returns the letters and the mean feature vector of each letter."""
+    letters = sorted(set(labels))
+    labels = np.array(labels)
+    templates = np.stack([features[labels == letter].mean(axis=0)
+                          for letter in letters])
+    return letters, templates
+
+
+def classify_glyphs(features, letters, templates, threshold=None):
+    """Classifies all glyphs at once as the letter of the nearest template.
+    Glyphs farther than threshold from every template become '?'. Returns
+    the letters and the distances.
+    """
+    if len(features) == 0:
+        return [], np.zeros(0, dtype=np.float32)
+
+    distances = ((features * features).sum(axis=1)[:, None] -
+                 2 * features @ templates.T +
+                 (templates * templates).sum(axis=1)[None, :])
+    best = distances.argmin(axis=1)
+    nearest = np.sqrt(np.maximum(distances[np.arange(len(best)), best], 0))
+    result = [letters[i] for i in best]
+    if threshold is not None:
+        result = [letter if distance <= threshold else '?'
+                  for letter, distance in zip(result, nearest)]
+    return result, nearest
+
+
+def save_templates(letters, templates, threshold, name=TEMPLATE_FILE):
+    """Writes the templates as bytes 0-255 to a JSON file."""
+    with open(name, "w") as f:
+        json.dump({"grid": GRID,
+                   "threshold": threshold,
+                   "letters": "".join(letters),
+                   "templates": np.rint(templates * 255).astype(int).tolist()},
+                  f, separators=(",", ":"))
+        f.write("\n")
+
+
+_templates = {}
+
+
+def load_templates(name=TEMPLATE_FILE):
+    """Returns (letters, templates, threshold) from the template file, or
+    None if it does not exist. The file is read only once per process.
+    """
+    if name not in _templates:
+        try:
+            with open(name) as f:
+                data = json.load(f)
+        except OSError:
+            return None
+        if data["grid"] != GRID:
+            return None
+        templates = np.array(data["templates"], dtype=np.float32) / 255
+        _templates[name] = (list(data["letters"]), templates,
+                            data["threshold"])
+    return _templates[name]
+
+
+def extract_samples(pattern="puzzles/*.PNG"):
+    """Returns the glyph features of every bubble in the images and the
+    letters the get_letter rules read from them.
+    """
+    import contextlib
+    import glob
+    import io
+
+    # solve imports this module, so it is imported here and only when the
+    # templates are rebuilt.
+    import solve
+
+    features = []
+    labels = []
+    for name in sorted(glob.glob(pattern)):
+        with contextlib.redirect_stdout(io.StringIO()):
+            samples = solve.get_glyph_samples(name)
+        for letter, feature in samples:
+            if letter != '?':
+                labels.append(letter)
+                features.append(feature)
+
+    return np.stack(features), labels
+
+
+def build_templates(pattern="puzzles/*.PNG", name=TEMPLATE_FILE):
+    """Rebuilds the template file from the images. The rejection threshold
+    is twice the largest distance of a sample to its own template.
+    """
+    features, labels = extract_samples(pattern)
+    letters, templates = make_templates(features, labels)
+    found, distances = classify_glyphs(features, letters, templates)
+    threshold = float(2 * distances.max())
+    save_templates(letters, templates, threshold, name)
+    return len(labels), letters, threshold
+
+
+if __name__ == '__main__':
+    count, letters, threshold = build_templates()
+    print("Built %d templates from %d glyphs into %s" %
+          (len(letters), count, TEMPLATE_FILE))
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Stage timers, search counters and peak memory for finding out where a
+slow puzzle spends its time.
+
+Everything is off unless enable() is called, by `--profile` on the command
+line or by setting WORDPOPPER_PROFILE=1. The hot loops only check the
+module-level `enabled` flag, so the cost when off is one global lookup per
+node. The report is a dict that can be written as JSON, and the stages can
+also be written as a Chrome trace (chrome://tracing or Perfetto).
+"""
+
+import contextlib
+import json
+import os
+import time
+import tracemalloc
+
+
+enabled = (os.environ.get("WORDPOPPER_PROFILE", "").strip().lower() in
+           ("1", "true", "yes", "on"))
+
+_counters = {}
+_stages = []
+_stack = []
+_origin = time.perf_counter()
+
+
+def enable(memory=True):
+    """Turns the instrumentation on. With memory, the peak memory of every
+    stage is traced too, which slows down allocations.
+    """
+    global enabled
+    enabled = True
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def reset():
+    """Forgets everything recorded so far."""
+    global _origin
+    _counters.clear()
+    del _stages[:]
+    del _stack[:]
+    _origin = time.perf_counter()
+
+
+def count(name, depth=None, amount=1):
+    """Adds amount to a counter. With a depth, the counter is a list with
+    one entry per depth.
+    """
+    if depth is None:
+        _counters[name] = _counters.get(name, 0) + amount
+        return
+    values = _counters.setdefault(name, [])
+    if len(values) <= depth:
+        values.extend([0] * (depth + 1 - len(values)))
+    values[depth] += amount
+
+
+def maximum(name, value):
+    """Keeps the largest value seen for a counter."""
+    if value > _counters.get(name, value - 1):
+        _counters[name] = value
+
+
+@contextlib.contextmanager
+def _stage(name):
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        if _stack:
+            _stack[-1][1] = max(_stack[-1][1],
+                                tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+    frame = [name, 0]
+    _stack.append(frame)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        _stack.pop()
+        record = {"name": name, "depth": len(_stack),
+                  "start": start - _origin, "seconds": end - start}
+        if tracing:
+            peak = max(frame[1], tracemalloc.get_traced_memory()[1])
+            record["peak_bytes"] = peak
+            if _stack:
+                _stack[-1][1] = max(_stack[-1][1], peak)
+            tracemalloc.reset_peak()
+        _stages.append(record)
+
+
+def stage(name):
+    """Returns a context manager that times the code inside it as a stage.
+    Stages can be nested. When the instrumentation is off it does nothing.
+    """
+    if not enabled:
+        return contextlib.nullcontext()
+    return _stage(name)
+
+
+def report():
+    """Returns the stages in the order they finished and the counters."""
+    return {"stages": list(_stages), "counters": dict(_counters)}
+
+
+def write_report(name):
+    """Writes the report as JSON."""
+    with open(name, "w") as f:
+        json.dump(report(), f, indent=1)
+        f.write("\n")
+
+
+def write_trace(name):
+    """Writes the stages as a Chrome trace-event file, with the counters as
+    the arguments of a final instant event.
+    """
+    events = []
+    for record in _stages:
+        event = {"name": record["name"], "ph": "X", "pid": os.getpid(),
+                 "tid": 0, "ts": record["start"] * 1e6,
+                 "dur": record["seconds"] * 1e6}
+        if "peak_bytes" in record:
+            event["args"] = {"peak_bytes": record["peak_bytes"]}
+        events.append(event)
+    events.append({"name": "counters", "ph": "i", "s": "g",
+                   "pid": os.getpid(), "tid": 0,
+                   "ts": (time.perf_counter() - _origin) * 1e6,
+                   "args": dict(_counters)})
+    with open(name, "w") as f:
+        json.dump({"traceEvents": events}, f)
+        f.write("\n")
+
+
+if enabled:
+    enable()
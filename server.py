@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""A long-running solver that answers over localhost HTTP or a Unix socket.
+
+The dictionary stays open between requests, and solves run in a pool of
+processes forked after it was loaded so the event loop stays responsive.
+
+    python3 server.py --port 8765
+    python3 server.py --unix /tmp/wordpopper.sock
+
+Endpoints:
+    POST /solve  with a PNG body (Content-Type: image/png), or a JSON body
+                 {"board": ["ABC", "D F", ...], "lens": [5, 3],
+                  "solver": "dlx", "search": "trie", "limit": 10}
+    GET  /stats  count of solved and failed requests, and p50 / p99 latency
+                 of the solved ones in milliseconds
+"""
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import io
+import json
+import multiprocessing
+import time
+
+from batch import solve_board
+from dictionary import open_dictionary
+from glyphs import load_templates
+from solve import get_cached_input, parse_board
+
+
+# How many of the latest request latencies /stats is computed from.
+LATENCY_WINDOW = 10000
+
+STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found",
+          405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+def solve_image(data, search="trie", solver="dlx", limit=None):
+    """Parses and solves a PNG given as bytes. Raises ValueError for an
+    upload that cannot be read as a puzzle.
+    """
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            board, pixel_to_rc, lens = get_cached_input(io.BytesIO(data))
+    except Exception as e:
+        raise ValueError("cannot read the image: %s: %s" %
+                         (type(e).__name__, e))
+    parsed = time.perf_counter()
+    result = solve_board(board, lens, search, solver, limit)
+    result["timings"]["parse"] = parsed - start
+    result["name"] = "upload"
+    return result
+
+
+def solve_json(request):
+    """Solves a pre-parsed board given as the decoded JSON body, in the
+    same shape solve.py --board reads. Raises ValueError for a board that
+    parse_board rejects.
+    """
+    if not isinstance(request, dict):
+        raise ValueError("the body must be a JSON object")
+    board, lens = parse_board(request["board"], request["lens"])
+    return solve_board(board, lens, request.get("search", "trie"),
+                       request.get("solver", "dlx"), request.get("limit"))
+
+
+def warm_up():
+    """Makes sure a worker has the dictionary and the glyph templates loaded
+    before any request.
+    """
+    open_dictionary()
+    load_templates()
+
+
+def percentile(values, fraction):
+    """Returns the value below which the given fraction of values lie."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class SolverServer:
+    """Answers solve requests and keeps latency statistics."""
+
+    def __init__(self, workers=None):
+        open_dictionary()
+        load_templates()
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        else:
+            context = None
+        self.pool = concurrent.futures.ProcessPoolExecutor(workers, context)
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.count = 0
+        self.errors = 0
+
+    def stats(self):
+        """Returns the request counts and the latency percentiles of the
+        solved requests.
+        """
+        result = {"requests": self.count, "errors": self.errors}
+        if self.latencies:
+            result["p50_ms"] = percentile(self.latencies, 0.50) * 1000
+            result["p99_ms"] = percentile(self.latencies, 0.99) * 1000
+        return result
+
+    async def solve(self, headers, body):
+        """Runs one solve request in the process pool."""
+        loop = asyncio.get_running_loop()
+        if headers.get("content-type", "").startswith("image/"):
+            return await loop.run_in_executor(self.pool, solve_image, body)
+        return await loop.run_in_executor(self.pool, solve_json,
+                                          json.loads(body))
+
+    async def respond(self, method, path, headers, body):
+        """Returns the (status, result) of a request."""
+        if path == "/stats":
+            if method != "GET":
+                return 405, {"error": "use GET"}
+            return 200, self.stats()
+        if path == "/solve":
+            if method != "POST":
+                return 405, {"error": "use POST"}
+            start = time.perf_counter()
+            # Failed requests are kept out of the latencies, so a burst of
+            # bad uploads does not skew p50 / p99.
+            try:
+                result = await self.solve(headers, body)
+            except (ValueError, KeyError, TypeError) as e:
+                self.errors += 1
+                return 400, {"error": "%s: %s" % (type(e).__name__, e)}
+            except Exception as e:
+                self.errors += 1
+                return 500, {"error": "%s: %s" % (type(e).__name__, e)}
+            self.latencies.append(time.perf_counter() - start)
+            self.count += 1
+            return 200, result
+        return 404, {"error": "unknown path %s" % path}
+
+    async def handle(self, reader, writer):
+        """Reads one HTTP request from the connection and answers it."""
+        try:
+            await self.answer(reader, writer)
+        finally:
+            writer.close()
+
+    async def answer(self, reader, writer):
+        """Reads the request of handle and writes the response."""
+        try:
+            request_line = await reader.readline()
+            method, path, version = request_line.decode("latin-1").split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if not line:
+                    break
+                key, value = line.split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0))
+            body = await reader.readexactly(length) if length else b""
+            status, result = await self.respond(method, path, headers, body)
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            status, result = 400, {"error": "bad request: %s" % e}
+
+        payload = json.dumps(result).encode()
+        writer.write(("HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n"
+                      "Content-Length: %d\r\nConnection: close\r\n\r\n" %
+                      (status, STATUS[status], len(payload))).encode())
+        writer.write(payload)
+        await writer.drain()
+
+    async def serve(self, host="127.0.0.1", port=8765, unix=None):
+        """Serves requests forever on a TCP port or a Unix socket."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.pool, warm_up)
+        if unix is not None:
+            server = await asyncio.start_unix_server(self.handle, unix)
+            print("Listening on %s" % unix, flush=True)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+            print("Listening on http://%s:%d" % (host, port), flush=True)
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", metavar="PATH",
+                        help="listen on a Unix socket instead of TCP")
+    parser.add_argument("--workers", type=int,
+                        help="number of solver processes "
+                        "(default: one per core)")
+    args = parser.parse_args()
+
+    server = SolverServer(args.workers)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.pool.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,117 +1,180 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-
-# PIL is PILLOW, the updated Python Imaging Library.
-from PIL import Image, ImageDraw, ImageColor
+# PIL (PILLOW, the updated Python Imaging Library), multiprocessing and
+# cProfile are imported where they are used, so solving a board given as
+# text does not pay for importing them.
+import numpy as np
+from dictionary import open_dictionary
+import instrument
+from dlx import ExactCover
+from glyphs import (TEMPLATE_FILE, classify_glyphs, glyph_features,
+                    load_templates)
+import argparse
+import contextlib
+import hashlib
+import inspect
+import itertools
+import io
+import json
 import os
 import sys
-import queue
 import math
 import time
 
 
-# These are colors represented as triples of RGB values.
-black = (0, 0, 0, 255)
-red = (255, 0, 0, 255)
-green = (0, 255, 0, 255)
-blue = (0, 0, 255, 255)
-white = (255, 255, 255, 255)
-
-# These are the directions for BFS traverse.
-dx = [-1, 0, 1, 0]
-dy = [0, 1, 0, -1]
+# These are the pixel classes stored in the label array.
+black = 0
+red = 1
+green = 2
+blue = 3
+white = 4
 
 # The 8 directions for traversing a board.
 dr = [-1, -1, -1, 0, 1, 1,  1,  0]
 dc = [-1,  0,  1, 1, 1, 0, -1, -1]
 
+# The key that marks the end of a word in a DAWG node.
+END = ""
 
-def in_bounds(x, y, R, C):
-    """Checks if an x,y coordinate is in a R x C board."""
-    return (0 <= x and x < R and 0 <= y and y < C)
+# Paths are stored as ints with PATH_BITS bits per cell, enough for boards
+# of up to 255 cells.
+PATH_BITS = 8
+PATH_MASK = (1 << PATH_BITS) - 1
 
+# Letter counts are packed into one int with COUNT_BITS bits per letter, the
+# highest of which is a guard bit, so a field holds counts up to 255. With
+# the guard bits set, subtracting a word clears the guard of every letter
+# that would go negative.
+COUNT_BITS = 9
+COUNT_GUARD = sum(1 << (COUNT_BITS * i + COUNT_BITS - 1) for i in range(26))
 
-def bfs(pixels, points, x1, y1, x2, y2, search_color, new_color):
-    """Performs a breadth-first search in the bounding box (x1, y1) to
-    (x2, y2). The BFS starts with points and changes all pixels of
-    search_color to new_color. Returns a bounding box.
-    """
-    minx = x2
-    miny = y2
-    maxx = x1
-    maxy = y1
-
-    # Add points to a Queue.
-    q = queue.Queue()
-    for point in points:
-        if x1 <= point[0] and point[0] <= x2 and y1 <= point[1] and \
-                point[1] <= y2 and pixels[point[0], point[1]] == search_color:
-            minx = min(point[0], minx)
-            miny = min(point[1], miny)
-            maxx = max(point[0], maxx)
-            maxy = max(point[1], maxy)
-            q.put(point)
-
-    visited = set()
-    while not q.empty():
-        point = q.get()
-        x = point[0]
-        y = point[1]
-
-        minx = min(point[0], minx)
-        miny = min(point[1], miny)
-        maxx = max(point[0], maxx)
-        maxy = max(point[1], maxy)
-
-        if point in visited:
-            continue
+# How letters are read from the bubbles by default, "template" or "rules".
+GLYPHS = "template"
 
-        visited.add(point)
-        pixels[x, y] = new_color
-        for k in range(4):
-            newx = x + dx[k]
-            newy = y + dy[k]
-            if x1 <= newx and newx <= x2 and y1 <= newy and newy <= y2 \
-                    and pixels[newx, newy] == search_color:
-                q.put((newx, newy))
+# The word lists tried in order until one of them solves the board.
+WORD_LISTS = ("allWords.txt",)
 
-    return ((minx, miny), (maxx, maxy))
+# The image is decimated to about this many pixels wide to find the areas
+# of the bubbles and the blanks before any pixel is classified in full.
+LAYOUT_WIDTH = 400
 
+# Parsed boards are cached in this directory, keyed by the hash of the image.
+BOARD_CACHE = ".board_cache"
+BOARD_CACHE_SIZE = 1000
 
-def get_row_nums(pixels, x1, y1, x2, y2):
-    """Finds the number of groups of black pixels in a given row.
-    This helps distinguish between different letters.
+
+def in_bounds(x, y, R, C):
+    """Checks if an x,y coordinate is in a R x C board."""
+    return (0 <= x and x < R and 0 <= y and y < C)
+
+
+def find_components(mask, x0=0, y0=0):
+    """Finds the 4-connected components of a boolean mask indexed as [x, y]
+    in a single pass. The mask is split into vertical runs, runs that touch
+    in neighbouring columns are merged with a vectorized union-find, and
+    every component is returned at once as a (label, box, pixel count)
+    triple. Boxes are ((minx, miny), (maxx, maxy)) shifted by (x0, y0).
+    Labels start at 1 and follow the order of each component's first pixel
+    when scanning x, then y. Also returns an array the shape of mask that
+    holds the label of every pixel, 0 for pixels outside the mask.
+    """
+    width, height = mask.shape
+    edges = np.zeros((width, height + 2), dtype=np.int8)
+    edges[:, 1:-1] = mask
+    edges = np.diff(edges, axis=1)
+    line, start = np.nonzero(edges == 1)
+    end = np.nonzero(edges == -1)[1]
+    if len(line) == 0:
+        return np.zeros(mask.shape, dtype=np.int32), []
+
+    # Run j in column x - 1 touches run i in column x when their y ranges
+    # overlap. Runs are sorted by (column, start), so the candidates of
+    # each run are a contiguous slice found with two binary searches.
+    stride = height + 1
+    start_key = line * stride + start
+    end_key = line * stride + end
+    lo = np.searchsorted(end_key, (line - 1) * stride + start, side="right")
+    hi = np.searchsorted(start_key, (line - 1) * stride + end, side="left")
+    span = np.maximum(hi - lo, 0)
+    a = np.repeat(np.arange(len(line)), span)
+    b = np.repeat(lo - np.cumsum(span) + span, span) + np.arange(span.sum())
+
+    # Hook the larger root onto the smaller one until every edge agrees, so
+    # each component ends up rooted at its first run.
+    parent = np.arange(len(line))
+    while len(a):
+        ra = parent[a]
+        rb = parent[b]
+        differ = ra != rb
+        if not differ.any():
+            break
+        np.minimum.at(parent, np.maximum(ra, rb)[differ],
+                      np.minimum(ra, rb)[differ])
+        while True:
+            jumped = parent[parent]
+            if (jumped == parent).all():
+                break
+            parent = jumped
+
+    roots, comp = np.unique(parent, return_inverse=True)
+    count = len(roots)
+    minx = line[roots]
+    maxx = np.zeros(count, dtype=line.dtype)
+    np.maximum.at(maxx, comp, line)
+    miny = np.full(count, height, dtype=start.dtype)
+    np.minimum.at(miny, comp, start)
+    maxy = np.zeros(count, dtype=end.dtype)
+    np.maximum.at(maxy, comp, end - 1)
+    pixels = np.bincount(comp, weights=end - start, minlength=count)
+
+    # Runs in a column never touch, so marking +label at each start and
+    # -label just past each end and summing down the column paints them.
+    labels = np.zeros((width, height + 1), dtype=np.int32)
+    labels[line, start] = comp + 1
+    labels[line, end] = -(comp + 1)
+    labels = np.cumsum(labels[:, :height], axis=1, dtype=np.int32)
+
+    components = []
+    for k in range(count):
+        box = ((int(minx[k]) + x0, int(miny[k]) + y0),
+               (int(maxx[k]) + x0, int(maxy[k]) + y0))
+        components.append((k + 1, box, int(pixels[k])))
+
+    return labels, components
+
+
+def collapse_counts(counts):
+    """Drops zero counts and repeated neighbouring counts, so that e.g.
+    [0, 1, 1, 2, 2, 0, 1] becomes [1, 2, 1].
     """
     ans = []
-    for i in range(y1, y2 + 1):
-        temp = 0
-        for j in range(x1 + 1, x2 + 1):
-            if pixels[j - 1, i] == green and pixels[j, i] == black:
-                temp += 1
+    for temp in counts.tolist():
         if temp != 0 and (len(ans) == 0 or ans[-1] != temp):
             ans.append(temp)
 
     return ans
 
 
+def get_row_nums(pixels, x1, y1, x2, y2):
+    """Finds the number of groups of black pixels in a given row.
+    This helps distinguish between different letters.
+    """
+    box = pixels[x1:x2 + 1, y1:y2 + 1]
+    starts = (box[:-1, :] == green) & (box[1:, :] == black)
+    return collapse_counts(np.count_nonzero(starts, axis=0))
+
+
 def get_col_nums(pixels, x1, y1, x2, y2):
     """Finds the number of groups of black pixels in a given column.
     This helps distinguish between different letters
     """
-    ans = []
-    for i in range(x1, x2 + 1):
-        temp = 0
-        for j in range(y1 + 1, y2 + 1):
-            if pixels[i, j - 1] == green and pixels[i, j] == black:
-                temp += 1
-        if temp != 0 and (len(ans) == 0 or ans[-1] != temp):
-            ans.append(temp)
-
-    return ans
+    box = pixels[x1:x2 + 1, y1:y2 + 1]
+    starts = (box[:, :-1] == green) & (box[:, 1:] == black)
+    return collapse_counts(np.count_nonzero(starts, axis=1))
 
 
-def get_letter(pixels, x1, y1, x2, y2, bpixel_count):
+def get_letter(pixels, x1, y1, x2, y2, bpixel_count, glyph_box=None):
     """Determines a character based on the number of groups of black pixels in
     the rows and columns. Characters with nondistinct identities are
     determined using total pixel count. If their total pixel count is not
@@ -120,6 +183,8 @@ def get_letter(pixels, x1, y1, x2, y2, bpixel_count):
     e.g. (an R has a higher pixel count than an A)
     e.g. (an L has no pixel in the upper right corner in its bounding box,
     but a T does)
+    glyph_box is the bounding box of the black strokes in the bubble. It is
+    found from the bubble's connected components when it is not given.
     """
 
     row_nums = get_row_nums(pixels, x1, y1, x2, y2)
@@ -152,23 +217,15 @@ def get_letter(pixels, x1, y1, x2, y2, bpixel_count):
     if row_nums == [1] and 3 in col_nums and 2 in col_nums:
         return 'Z'
 
-    x3 = x2
-    y3 = y2
-    x4 = x1
-    y4 = y1
-
-    for i in range(x1, x2+1):
-        for j in range(y1, y2+1):
-            if pixels[i, j] == black:
-                small_box = bfs(pixels, ((i, j),), x1, y1, x2, y2, black, red)
-                x3 = min(small_box[0][0], x3)
-                y3 = min(small_box[0][1], y3)
-                x4 = max(small_box[1][0], x4)
-                y4 = max(small_box[1][1], y4)
+    if glyph_box is None:
+        strokes = find_components(pixels[x1:x2 + 1, y1:y2 + 1] == black,
+                                  x1, y1)[1]
+        glyph_box = get_glyph_box(strokes, ((x1, y1), (x2, y2)))
+    (x3, y3), (x4, y4) = glyph_box
 
     if row_nums == [1, 2, 1, 2] and col_nums == [1, 2, 1]:
-        if (pixels[x3, y3] == red or pixels[x3 + 1, y3] == red or
-                pixels[x3, y3+1] == red or pixels[x3 + 1, y3+1] == red):
+        if (pixels[x3, y3] == black or pixels[x3 + 1, y3] == black or
+                pixels[x3, y3+1] == black or pixels[x3 + 1, y3+1] == black):
             return 'R'
         else:
             return 'A'
@@ -178,102 +235,249 @@ def get_letter(pixels, x1, y1, x2, y2, bpixel_count):
 
     if row_nums == [1, 2, 1, 2, 1] and col_nums == [1, 2, 3, 2, 1]:
         avgy = (y3+y4)//2
-        if (pixels[x3, avgy] == red or pixels[x3, avgy - 1] == red or
-                pixels[x3, avgy + 1] == red):
+        if (pixels[x3, avgy] == black or pixels[x3, avgy - 1] == black or
+                pixels[x3, avgy + 1] == black):
             return 'G'
         return 'S'
 
     if row_nums == [1] and col_nums == [1]:
-        if ((pixels[x4, y3] == red or pixels[x4 - 1, y3] == red or
-            pixels[x4, y3+1] == red or pixels[x4 - 1, y3 + 1] == red) and
-            (pixels[x4, y4] == red or pixels[x4-1, y4] == red or
-                pixels[x4, y4 - 1] == red or pixels[x4-1, y4-1] == red)):
+        if ((pixels[x4, y3] == black or pixels[x4 - 1, y3] == black or
+            pixels[x4, y3+1] == black or pixels[x4 - 1, y3 + 1] == black) and
+            (pixels[x4, y4] == black or pixels[x4-1, y4] == black or
+                pixels[x4, y4 - 1] == black or pixels[x4-1, y4-1] == black)):
             return 'I'
-        elif pixels[x3, y4] == red or pixels[x3 + 1, y4] == red or \
-                pixels[x3, y4 - 1] == red or pixels[x3 - 1, y4 - 1] == red:
+        elif pixels[x3, y4] == black or pixels[x3 + 1, y4] == black or \
+                pixels[x3, y4 - 1] == black or pixels[x3 - 1, y4 - 1] == black:
             return 'L'
         return 'T'
 
     if row_nums == [1, 2, 1] and col_nums == [1, 2, 1]:
         avgy = (y3 + y4) // 2
         avgx = (x3 + x4) // 2
-        if pixels[avgx, avgy + int(1/13 * (y4 - y3))] == red:
+        if pixels[avgx, avgy + int(1/13 * (y4 - y3))] == black:
             return 'P'
-        if pixels[x3, y4] == red or pixels[x3 + 1, y4] == red or \
-                pixels[x3, y4 - 1] == red or pixels[x3 - 1, y4 - 1] == red:
+        if pixels[x3, y4] == black or pixels[x3 + 1, y4] == black or \
+                pixels[x3, y4 - 1] == black or pixels[x3 - 1, y4 - 1] == black:
             return 'D'
         return 'O'
 
     if row_nums == [2, 1] and col_nums == [1]:
         avgy = (y3 + y4) // 2
-        if (pixels[x3, avgy] == red or pixels[x3, avgy-1] == red or
-                pixels[x3, avgy+1] == red):
+        if (pixels[x3, avgy] == black or pixels[x3, avgy-1] == black or
+                pixels[x3, avgy+1] == black):
             return 'U'
         avgx = (x3 + x4) // 2
-        if (pixels[avgx, avgy] == red):
+        if (pixels[avgx, avgy] == black):
             return 'Y'
         return 'V'
 
     return '?'
 
 
+def get_glyph_box(strokes, box):
+    """Returns the bounding box of the strokes that lie inside box, or the
+    inverted box when there are none.
+    """
+    (x1, y1), (x2, y2) = box
+    x3 = x2
+    y3 = y2
+    x4 = x1
+    y4 = y1
+    for label, small_box, count in strokes:
+        if x1 <= small_box[0][0] and small_box[1][0] <= x2 and \
+                y1 <= small_box[0][1] and small_box[1][1] <= y2:
+            x3 = min(small_box[0][0], x3)
+            y3 = min(small_box[0][1], y3)
+            x4 = max(small_box[1][0], x4)
+            y4 = max(small_box[1][1], y4)
+
+    return ((x3, y3), (x4, y4))
+
+
+def format_board(board, start_space=""):
+    """Returns the elements of the board as the text print_board prints."""
+    rule = start_space + "-" * ((len(board[0][0]) + 1) * len(board[0]) + 3)
+    lines = [rule]
+    for row in board:
+        lines.append(start_space + "| " +
+                     "".join(elem + " " for elem in row) + "|")
+    lines.append(rule)
+    return "\n".join(lines) + "\n"
+
+
 def print_board(board, start_space=""):
     """This method prints the elements of the board."""
-    print(start_space + "-" * ((len(board[0][0]) + 1) * len(board[0]) + 3))
-    for row in board:
-        print(start_space + "|", end=" ")
-        for elem in row:
-            print(elem, end=" ")
-        print("|")
+    sys.stdout.write(format_board(board, start_space))
 
-    print(start_space + "-" * ((len(board[0][0]) + 1) * len(board[0]) + 3))
 
+def image_rgb(img):
+    """Returns the pixels of a PIL image as an RGB array indexed [y, x]."""
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA")
+    return np.asarray(img)[:, :, :3]
 
-def get_input(name=None):
-    """This method retrieves a PNG file of the WordBubbles! puzzle and
-    obtain the character matrix, the mapping from pixels to row / col, and
-    the lengths needed to solve the puzzle.
+
+def classify_rgb(rgb):
+    """Classifies every pixel of an RGB array indexed [y, x] as black, red,
+    white or blue in one vectorized pass. Returns a uint8 label array
+    indexed as [x, y], the same way as the PIL pixel access object.
     """
-    if name is None:
-        print("no input picture")
-        sys.exit(-1)
+    r = rgb[:, :, 0]
+    g = rgb[:, :, 1]
+    b = rgb[:, :, 2]
 
-    img = Image.open(name)
-    pixels = img.load()
-    img_1 = Image.new(img.mode, img.size)
-    pixels_1 = img_1.load()
+    # Later assignments win, so go from the weakest rule to the strongest.
+    labels = np.full(r.shape, blue, dtype=np.uint8)
+    labels[((rgb >= 200) & (rgb <= 228)).all(axis=2)] = white
+    labels[(r <= 155) | (g <= 155) | (b <= 155)] = red
+    labels[(r >= 251) & (b >= 251)] = black
 
-    print("loading image...\n[", end="")
-    print("L", end="", flush=True)
+    return np.ascontiguousarray(labels.T)
 
-    for i in range(img.size[0]):
-        for j in range(img.size[1]):
-            pxl = pixels[i, j]
-            if (pxl[0] >= 251 and pxl[2] >= 251):
-                pixels_1[i, j] = black
-            elif (pxl[0] <= 155 or pxl[1] <= 155 or pxl[2] <= 155):
-                pixels_1[i, j] = red
-            elif 200 <= pxl[0] and pxl[0] <= 228 and 200 <= pxl[1] and \
-                    pxl[1] <= 228 and 200 <= pxl[2] and pxl[2] <= 228:
-                pixels_1[i, j] = white
-            else:
-                pixels_1[i, j] = blue
 
-    box_top = ((0, 240), (img.size[0], img.size[1]//2 + 160))
-    box_bot = ((0, img.size[1]//2 + 160), (img.size[0], img.size[1] - 480))
+def round_components(mask):
+    """Returns the boxes of the components of mask that look like filled
+    circles: at least 4 pixels wide, about as wide as high, and covering
+    at least half of their box.
+    """
+    boxes = []
+    for label, box, count in find_components(mask)[1]:
+        width = box[1][0] - box[0][0] + 1
+        height = box[1][1] - box[0][1] + 1
+        if (width >= 4 and 0.8 <= width / height <= 1.25 and
+                count >= width * height / 2):
+            boxes.append(box)
+    return boxes
+
+
+def same_size(boxes):
+    """Returns the group of boxes of about the same width, within 15%, that
+    covers the largest area. A few large bubbles outweigh many small specks
+    such as the letters of an ad.
+    """
+    def similar(a, b):
+        width_a = a[1][0] - a[0][0]
+        width_b = b[1][0] - b[0][0]
+        return abs(width_a - width_b) <= 0.15 * max(width_a, width_b)
+
+    def area(box):
+        return (box[1][0] - box[0][0] + 1) * (box[1][1] - box[0][1] + 1)
+
+    if not boxes:
+        return []
+    best = max(boxes, key=lambda box: sum(area(other) for other in boxes
+                                          if similar(box, other)))
+    return [box for box in boxes if similar(box, best)]
+
+
+def scale_area(boxes, step, width, height):
+    """Turns boxes found in an image decimated by step into the box around
+    all of them in the full image, with a margin of two steps, and the
+    median width of one box in full image pixels. Returns None for no
+    boxes.
+    """
+    if not boxes:
+        return None
+    margin = 2 * step
+    area = ((max(0, min(box[0][0] for box in boxes) * step - margin),
+             max(0, min(box[0][1] for box in boxes) * step - margin)),
+            (min(width - 1, max(box[1][0] for box in boxes) * step + margin),
+             min(height - 1, max(box[1][1] for box in boxes) * step + margin)))
+    widths = sorted(box[1][0] - box[0][0] + 1 for box in boxes)
+    return area, widths[len(widths) // 2] * step
+
+
+def find_areas(rgb):
+    """Finds the bubble grid and the length blanks in a copy of the image
+    decimated to about LAYOUT_WIDTH pixels wide, so that nothing depends on
+    the resolution of the screenshot. The bubbles are the largest group of
+    red circles of the same size, and the blanks are the largest group of
+    white circles of the same size below them. Returns the (area, size)
+    of the bubbles and of the blanks from scale_area, the blanks None when
+    there are none.
+    """
+    height, width = rgb.shape[:2]
+    step = max(1, round(width / LAYOUT_WIDTH))
+    small = classify_rgb(rgb[::step, ::step])
+
+    bubbles = same_size(round_components(small == red))
+    if not bubbles:
+        raise ValueError("found no bubbles in the image")
+    bottom = max(box[1][1] for box in bubbles)
+    blanks = same_size([box for box in round_components(small == white)
+                        if box[0][1] > bottom])
+
+    return (scale_area(bubbles, step, width, height),
+            scale_area(blanks, step, width, height))
+
+
+def classify_areas(rgb, areas):
+    """Classifies the pixels of the areas from find_areas only. The rest of
+    the label array is left blue.
+    """
+    pixels = np.full(rgb.shape[1::-1], blue, dtype=np.uint8)
+    for found in areas:
+        if found is not None:
+            (x1, y1), (x2, y2) = found[0]
+            pixels[x1:x2 + 1, y1:y2 + 1] = classify_rgb(
+                rgb[y1:y2 + 1, x1:x2 + 1])
+    return pixels
+
+
+def classify_image(img):
+    """Finds the areas of the bubbles and the blanks in the image and
+    classifies their pixels. Returns the label array and the areas.
+    """
+    rgb = image_rgb(img)
+    areas = find_areas(rgb)
+    return classify_areas(rgb, areas), areas
+
+
+def parse_image(name):
+    """Classifies the pixels of the image and finds the bubbles, the strokes
+    of their letters and the word lengths. Returns the label array, the
+    bubble boxes, the stroke components and the lengths.
+    """
+    from PIL import Image
+
+    print("L", end="", flush=True)
+    with instrument.stage("classify"):
+        pixels_1, areas = classify_image(Image.open(name))
+    with instrument.stage("layout"):
+        bubble_box, strokes, lens = find_layout(pixels_1, areas)
+    return pixels_1, bubble_box, strokes, lens
+
+
+def find_layout(pixels_1, areas):
+    """Finds the bubbles, the strokes of their letters and the word lengths
+    in the label array of classify_areas. Bubbles are the red components
+    of the bubble area wider than half a bubble, and blanks the white
+    components of the blank area wider than half a blank. The bubbles are
+    painted green and the length blanks blue in place.
+    """
+    (box_top, bubble_size), blank_area = areas
 
     print("O", end="", flush=True)
     print("A", end="", flush=True)
 
+    # Label every red and black component of the bubble area in one pass
+    # each. The black components inside the bubbles are the strokes of the
+    # letters.
+    top = pixels_1[box_top[0][0]:box_top[1][0] + 1,
+                   box_top[0][1]:box_top[1][1] + 1]
+    components = find_components(top == red, box_top[0][0],
+                                 box_top[0][1])[1]
+    # Specks of a few pixels where a smoothly scaled bubble blends into the
+    # background are not strokes.
+    strokes = [stroke for stroke in find_components(top == black,
+                                                    box_top[0][0],
+                                                    box_top[0][1])[1]
+               if stroke[2] * 500 >= bubble_size * bubble_size]
+
     bubble_box = []
-    for i in range(box_top[0][0], box_top[1][0], 15):
-        for j in range(box_top[0][1], box_top[1][1], 15):
-            if pixels_1[i, j] == red:
-                box_small = bfs(pixels_1, ((i, j),), box_top[0][0],
-                                box_top[0][1], box_top[1][0], box_top[1][1],
-                                red, green)
-                if((box_small[1][0] - box_small[0][0]) > 90):
-                    bubble_box.append(box_small)
+    for label, box_small, count in components:
+        if((box_small[1][0] - box_small[0][0]) * 2 > bubble_size):
+            bubble_box.append(box_small)
 
     print("D", end="", flush=True)
 
@@ -283,21 +487,21 @@ def get_input(name=None):
         x2 = box[1][0]
         y2 = box[1][1]
 
-        points = ((x1, y1), (x1, y2), (x2, y1), (x2, y2))
-        for i in range(x1, x2+1):
-            for j in range(y1, y2+1):
-                if pixels_1[i, j] != black:
-                    pixels_1[i, j] = green
+        region = pixels_1[x1:x2 + 1, y1:y2 + 1]
+        region[region != black] = green
 
     little_box = []
     print("I", end="", flush=True)
 
-    for i in range(box_bot[0][0], box_bot[1][0]):
-        for j in range(box_bot[0][1], box_bot[1][1]):
-            if pixels_1[i, j] == white:
-                box_small = bfs(pixels_1, ((i, j),), box_bot[0][0],
-                                box_bot[0][1], box_bot[1][0], box_bot[1][1],
-                                white, black)
+    blank_size = 0
+    if blank_area is not None:
+        box_bot, blank_size = blank_area
+        bot = pixels_1[box_bot[0][0]:box_bot[1][0] + 1,
+                       box_bot[0][1]:box_bot[1][1] + 1]
+        for label, box_small, count in find_components(bot == white,
+                                                       box_bot[0][0],
+                                                       box_bot[0][1])[1]:
+            if (box_small[1][0] - box_small[0][0]) * 2 > blank_size:
                 little_box.append(box_small)
 
     print("N", end="", flush=True)
@@ -309,16 +513,14 @@ def get_input(name=None):
         x2 = box[1][0]
         y2 = box[1][1]
 
-        for i in range(x1, x2+1):
-            for j in range(y1, y2+1):
-                pixels_1[i, j] = blue
+        pixels_1[x1:x2 + 1, y1:y2 + 1] = blue
 
         if (len(y_to_length) == 0):
             y_to_length[y1] = 1
         else:
             valid = False
             for key in y_to_length:
-                if abs(key - y1) <= 10:
+                if abs(key - y1) <= blank_size // 2:
                     y_to_length[key] += 1
                     valid = True
                     break
@@ -329,11 +531,151 @@ def get_input(name=None):
     for key in y_to_length:
         lens.append(y_to_length[key])
 
+    return bubble_box, strokes, lens
+
+
+def grid_pitch(bubble_box):
+    """Returns the distance between the tops of neighbouring rows of
+    bubbles, the smallest gap between two rows or columns that is more than
+    half a bubble.
+    """
+    size = bubble_box[0][1][0] - bubble_box[0][0][0] + 1
+    gaps = []
+    for axis in (0, 1):
+        starts = sorted(set(box[0][axis] for box in bubble_box))
+        gaps.extend(b - a for a, b in zip(starts, starts[1:])
+                    if 2 * (b - a) > size)
+    if not gaps:
+        return 2 * size
+    return min(gaps)
+
+
+def read_letters(pixels, bubble_box, strokes, bpixel_counts, glyphs=GLYPHS):
+    """Reads the letter in every bubble, either with the get_letter rules or
+    by matching all glyphs against the templates in glyphs.json at once.
+    The rules are used when there are no templates.
+    """
+    glyph_boxes = [get_glyph_box(strokes, box) for box in bubble_box]
+    templates = load_templates() if glyphs == "template" else None
+    if templates is not None:
+        features = glyph_features(pixels, glyph_boxes, black)
+        return classify_glyphs(features, *templates)[0]
+
+    letters = []
+    for box, glyph_box, count in zip(bubble_box, glyph_boxes,
+                                     bpixel_counts):
+        (x1, y1), (x2, y2) = box
+        letters.append(get_letter(pixels, x1, y1, x2, y2, count, glyph_box))
+    return letters
+
+
+def black_counts(pixels, bubble_box):
+    """Returns the number of black pixels in each bubble."""
+    return [int(np.count_nonzero(pixels[x1:x2 + 1, y1:y2 + 1] == black))
+            for (x1, y1), (x2, y2) in bubble_box]
+
+
+def get_glyph_samples(name):
+    """Returns a (letter, features) pair for every bubble of the image, with
+    the letter read by the get_letter rules. These are the samples the
+    glyph templates are built from.
+    """
+    pixels, bubble_box, strokes, lens = parse_image(name)
+    counts = black_counts(pixels, bubble_box)
+    letters = read_letters(pixels, bubble_box, strokes, counts, "rules")
+    features = glyph_features(pixels, [get_glyph_box(strokes, box)
+                                       for box in bubble_box], black)
+    return list(zip(letters, features))
+
+
+def read_board(name):
+    """Reads a board that was already transcribed, from a file or from stdin
+    when name is "-". JSON looks like the body of a server request,
+    {"board": ["ABC", "D F", ...], "lens": [5, 3]}. Text has one row of
+    letters per line, with a space or a "." for a blank cell, and the word
+    lengths on the last line, e.g. "5 3". Returns the board and the lengths.
+    Raises ValueError for a board that cannot be read.
+    """
+    if name == "-":
+        text = sys.stdin.read()
+    else:
+        with open(name) as f:
+            text = f.read()
+
+    if text.lstrip().startswith("{"):
+        data = json.loads(text)
+        if not isinstance(data, dict) or not {"board", "lens"} <= set(data):
+            raise ValueError('%s needs "board" and "lens"' % name)
+        return parse_board(data["board"], data["lens"])
+
+    lines = [line.rstrip("\r\n") for line in text.splitlines()]
+    while lines and not lines[-1].strip():
+        lines.pop()
+    if not lines:
+        raise ValueError("%s is empty" % name)
+    lens = [int(length) for length in lines.pop().replace(",", " ").split()]
+    # A row of blanks inside the board is kept, or the rows below it would
+    # move up. Only empty lines before the lengths are dropped.
+    rows = list(lines)
+    while rows and not rows[-1].strip():
+        rows.pop()
+    # Editors strip trailing blanks, so short lines are padded.
+    width = max((len(row) for row in rows), default=0)
+    return parse_board([row.ljust(width) for row in rows], lens)
+
+
+def parse_board(rows, lens):
+    """Turns rows of letters, with a space or a "." for a blank cell, and
+    the word lengths into a board and a list of lengths. Letters are upper
+    cased. Raises ValueError unless the rows are non-empty, of the same
+    width and hold only letters A-Z and blanks, and the lengths are
+    positive and add up to the number of letters, since every letter is
+    used by exactly one word.
+    """
+    if not isinstance(rows, list) or not rows:
+        raise ValueError("the board has no rows")
+    if not all(isinstance(row, str) for row in rows):
+        raise ValueError("every row of the board must be a string")
+    width = len(rows[0])
+    if width == 0 or any(len(row) != width for row in rows):
+        raise ValueError("the rows of the board must be non-empty and of "
+                         "the same width")
+    if len(rows) * width > PATH_MASK:
+        raise ValueError("the board has more than %d cells" % PATH_MASK)
+    board = [[' ' if char == '.' else char.upper() for char in row]
+             for row in rows]
+    for row in board:
+        for char in row:
+            if char != ' ' and not 'A' <= char <= 'Z':
+                raise ValueError("%r is not a letter A-Z or a blank" % char)
+    lens = [int(length) for length in lens]
+    if any(length < 1 for length in lens):
+        raise ValueError("the word lengths must be positive")
+    letters = sum(char != ' ' for row in board for char in row)
+    if sum(lens) != letters:
+        raise ValueError("the word lengths add up to %d, but the board has "
+                         "%d letters" % (sum(lens), letters))
+    return board, lens
+
+
+def get_input(name=None, glyphs=GLYPHS):
+    """This method retrieves a PNG file of the WordBubbles! puzzle and
+    obtain the character matrix, the mapping from pixels to row / col, and
+    the lengths needed to solve the puzzle. glyphs picks how letters are
+    read, "template" or "rules".
+    """
+    if name is None:
+        print("no input picture")
+        sys.exit(-1)
+
+    print("loading image...\n[", end="")
+    pixels_1, bubble_box, strokes, lens = parse_image(name)
+
     side_length = 0
     while (side_length) ** 2 < len(bubble_box):
         side_length += 1
 
-    bubble_size = (bubble_box[0][1][0] - bubble_box[0][0][0])
+    pitch = grid_pitch(bubble_box)
 
     bpixel_count = []
     for i in range(side_length):
@@ -374,32 +716,25 @@ def get_input(name=None):
         x2 = box[1][0]
         y2 = box[1][1]
 
-        row = (y1 - miny) // (bubble_size + 10)
-        col = (x1 - minx) // (bubble_size + 10)
+        row = round((y1 - miny) / pitch)
+        col = round((x1 - minx) / pitch)
         pixel_to_rc[box[0]] = (row, col)
 
-        temp = 0
-        for i in range(x1, x2 + 1):
-            for j in range(y1, y2 + 1):
-                if pixels_1[i, j] == black:
-                    temp += 1
-
-        bpixel_count[row][col] = temp
+        bpixel_count[row][col] = int(np.count_nonzero(
+            pixels_1[x1:x2 + 1, y1:y2 + 1] == black))
 
     print("'", end="", flush=True)
 
+    counts = []
     for box in bubble_box:
-        x1 = box[0][0]
-        y1 = box[0][1]
-        x2 = box[1][0]
-        y2 = box[1][1]
-
-        row_nums = get_row_nums(pixels_1, x1, y1, x2, y2)
-        col_nums = get_col_nums(pixels_1, x1, y1, x2, y2)
+        row, col = pixel_to_rc[box[0]]
+        counts.append(bpixel_count[row][col])
 
+    with instrument.stage("glyphs"):
+        letters = read_letters(pixels_1, bubble_box, strokes, counts, glyphs)
+    for box, letter in zip(bubble_box, letters):
         row, col = pixel_to_rc[box[0]]
-        board[row][col] = get_letter(pixels_1, x1, y1, x2, y2,
-                                     bpixel_count[row][col])
+        board[row][col] = letter
 
     print("]")
     print("This is the board:")
@@ -408,89 +743,340 @@ def get_input(name=None):
     return board, pixel_to_rc, lens
 
 
-def get_word_from_file(lens, name="allWords.txt"):
-    """This method gets english words from a dictionary text file."""
-    with open(name, "r") as f:
-        for line in f.readlines():
-            line = line.rstrip("\n")
-            word = line.upper()
-            if len(word) in lens:
-                yield word
+def parser_version(glyphs=GLYPHS):
+    """Returns a hash of the source of every function that turns an image
+    into a board, and of the glyph templates when they are used, so that
+    changing any of the rules invalidates the boards cached with the old
+    ones.
+    """
+    if glyphs not in _parser_version:
+        source = "".join(inspect.getsource(function) for function in (
+            image_rgb, classify_rgb, round_components, same_size, scale_area,
+            find_areas, classify_areas, classify_image, find_components,
+            collapse_counts, get_row_nums, get_col_nums, get_glyph_box,
+            get_letter, parse_image, find_layout, grid_pitch, read_letters,
+            get_input, glyph_features, classify_glyphs))
+        digest = hashlib.sha256(source.encode())
+        if glyphs == "template" and os.path.exists(TEMPLATE_FILE):
+            with open(TEMPLATE_FILE, "rb") as f:
+                digest.update(f.read())
+        digest.update(glyphs.encode())
+        _parser_version[glyphs] = digest.hexdigest()[:16]
+    return _parser_version[glyphs]
+
+
+_parser_version = {}
+
+
+def get_cached_input(name, cache=BOARD_CACHE, max_entries=BOARD_CACHE_SIZE,
+                     glyphs=GLYPHS):
+    """Works like get_input, but first looks the image up in an on-disk cache
+    keyed by the SHA-256 of its bytes. A hit skips decoding the image. The
+    cache keeps at most max_entries boards and evicts the least recently
+    used one, going by file modification time.
+    """
+    if hasattr(name, "read"):
+        data = name.read()
+    else:
+        with open(name, "rb") as f:
+            data = f.read()
+    entry = os.path.join(cache, hashlib.sha256(data).hexdigest() + ".json")
+
+    # An entry that cannot be read, or was written by another version or in
+    # another shape, is a miss and gets written again.
+    try:
+        with open(entry) as f:
+            cached = json.load(f)
+        if cached["version"] != parser_version(glyphs):
+            raise ValueError("stale cache entry")
+        board = [list(row) for row in cached["board"]]
+        pixel_to_rc = {(x, y): (r, c) for x, y, r, c in cached["pixel_to_rc"]}
+        lens = cached["lens"]
+    except (OSError, ValueError, KeyError, TypeError):
+        cached = None
+
+    if cached is not None:
+        if instrument.enabled:
+            instrument.count("cache.hits")
+        os.utime(entry)
+        print("loaded board from cache")
+        print("This is the board:")
+        print_board(board, "\t")
+        return board, pixel_to_rc, lens
+
+    if instrument.enabled:
+        instrument.count("cache.misses")
+    board, pixel_to_rc, lens = get_input(io.BytesIO(data), glyphs)
+
+    os.makedirs(cache, exist_ok=True)
+    temp = "%s.%d.tmp" % (entry, os.getpid())
+    with open(temp, "w") as f:
+        json.dump({"version": parser_version(glyphs),
+                   "board": ["".join(row) for row in board],
+                   "lens": lens,
+                   "pixel_to_rc": [[x, y, r, c] for (x, y), (r, c)
+                                   in pixel_to_rc.items()]}, f)
+    os.replace(temp, entry)
+    evict_cache(cache, max_entries)
+
+    return board, pixel_to_rc, lens
 
 
-def triplet_prune(board, lens):
-    """Removes words that contain triplets not found in the board."""
-    my_set = set()
+def evict_cache(cache, max_entries):
+    """Removes the least recently used boards until at most max_entries
+    are left.
+    """
+    entries = []
+    for file_name in os.listdir(cache):
+        if file_name.endswith(".json"):
+            path = os.path.join(cache, file_name)
+            try:
+                entries.append((os.stat(path).st_mtime_ns, path))
+            except OSError:
+                pass
+
+    entries.sort()
+    for mtime, path in entries[:max(0, len(entries) - max_entries)]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def board_ngrams(board):
+    """Returns the letter counts of the board and bitmaps of the bigrams and
+    trigrams it contains, as flat bool arrays indexed by a * 26 + b and
+    a * 26 * 26 + b * 26 + c. A trigram may not come back to its first cell.
+    """
     R = len(board)
     C = len(board[0])
-    for i in range(R):
-        for j in range(C):
-            for k in range(8):
-                i1 = i + dr[k]
-                j1 = j + dc[k]
-                if in_bounds(i1, j1, R, C):
-                    for m in range(8):
-                        i2 = i1 + dr[m]
-                        j2 = j1 + dc[m]
-                        if (not (i2 == i and j2 == j) and
-                                in_bounds(i2, j2, R, C)):
-                            if board[i][j] != ' ' and board[i1][j1] != ' '\
-                             and board[i2][j2] != ' ':
-                                my_set.add(board[i][j] + board[i1][j1] +
-                                           board[i2][j2])
+    codes = [ord(char) - ord('A') if 'A' <= char <= 'Z' else -1
+             for row in board for char in row]
+    neighbors = get_neighbors(board)
+
+    counts = np.zeros(26, dtype=np.uint8)
+    bigrams = np.zeros(26 * 26, dtype=bool)
+    trigrams = np.zeros(26 * 26 * 26, dtype=bool)
+    for cell in range(R * C):
+        a = codes[cell]
+        if a < 0:
+            continue
+        counts[a] += 1
+        for cell1, bit1 in neighbors[cell]:
+            b = codes[cell1]
+            if b < 0:
+                continue
+            bigrams[a * 26 + b] = True
+            for cell2, bit2 in neighbors[cell1]:
+                c = codes[cell2]
+                if c >= 0 and cell2 != cell:
+                    trigrams[(a * 26 + b) * 26 + c] = True
+
+    return counts, bigrams, trigrams
+
+
+def triplet_prune(board, lens, dictionary=None):
+    """Removes words that contain triplets not found in the board. Only the
+    length buckets in lens are read from the compiled dictionary, and each
+    bucket is filtered at once: first by the letter counts of the board,
+    then by looking the pre-encoded trigrams up in the board's bitmap.
+    """
+    counts, bigrams, trigrams = board_ngrams(board)
+
+    if dictionary is None:
+        dictionary = open_dictionary()
 
     ans = []
-    for word in get_word_from_file(lens):
-        valid = True
-        for j in range(2, len(word)):
-            key = word[j-2] + word[j-1] + word[j]
-            if key not in my_set:
-                valid = False
-                break
-        if valid:
-            ans.append(word)
+    for length in sorted(set(lens)):
+        rows = np.flatnonzero((dictionary.counts(length) <= counts)
+                              .all(axis=1))
+        if length >= 3:
+            rows = rows[trigrams[dictionary.trigrams(length)[rows]]
+                        .all(axis=1)]
+        elif length == 2:
+            letters = dictionary.letters(length)[rows].astype(np.intp)
+            rows = rows[bigrams[(letters[:, 0] - ord('A')) * 26 +
+                                letters[:, 1] - ord('A')]]
+        ans.extend(dictionary.words(length, rows))
+
+        if instrument.enabled:
+            instrument.count("triplet_prune.words", length,
+                             len(dictionary.counts(length)))
+            instrument.count("triplet_prune.survivors", length, len(rows))
 
     return ans
 
 
-def check_word(board, word, word_to_location, r, c, visited, index, cur_list):
-    """Checks if the word exists in the board."""
+def get_neighbors(board):
+    """Lists the (cell, bit) pairs of the neighbours of every cell in the
+    order of dr and dc. A cell is r * C + c and its bit is 1 << cell.
+    """
+    R = len(board)
+    C = len(board[0])
+    neighbors = []
+    for r in range(R):
+        for c in range(C):
+            temp = []
+            for i in range(8):
+                new_r = r + dr[i]
+                new_c = c + dc[i]
+                if in_bounds(new_r, new_c, R, C):
+                    cell = new_r * C + new_c
+                    temp.append((cell, 1 << cell))
+            neighbors.append(temp)
+
+    return neighbors
+
+
+def decode_path(path, C):
+    """Turns a path stored as an int back into a list of (r, c) tuples.
+    Each cell of the path is stored as cell + 1 in PATH_BITS bits, first
+    cell lowest, so a zero digit marks the end of the path.
+    """
+    coords = []
+    while path:
+        cell = (path & PATH_MASK) - 1
+        coords.append((cell // C, cell % C))
+        path >>= PATH_BITS
+
+    return coords
+
+
+def encode_path(coords, C):
+    """Turns a list of (r, c) tuples into a path int, see decode_path."""
+    path = 0
+    for i, (r, c) in enumerate(coords):
+        path |= (r * C + c + 1) << (PATH_BITS * i)
+    return path
+
+
+def check_word(letters, neighbors, word, word_to_location, cell, visited,
+               index, path):
+    """Checks if the word exists in the board. visited is a bitmask of the
+    cells used so far and path is the int encoding of the cells in order.
+    """
+    if instrument.enabled:
+        instrument.count("check_word.nodes", index)
     if(index >= len(word)):
         if word not in word_to_location:
             word_to_location[word] = []
-        new_list = []
-        for coord in cur_list:
-            new_list.append(coord)
-        word_to_location[word].append(new_list)
+        word_to_location[word].append(path)
         return
-    for i in range(8):
-        new_r = r + dr[i]
-        new_c = c + dc[i]
-        if in_bounds(new_r, new_c, len(board), len(board)):
-            if not visited[new_r][new_c]:
-                if board[new_r][new_c] is word[index]:
-                    visited[new_r][new_c] = True
-                    cur_list.append((new_r, new_c))
-                    check_word(board, word, word_to_location, new_r,
-                               new_c, visited, index + 1, cur_list)
-                    cur_list.remove((new_r, new_c))
-                    visited[new_r][new_c] = False
-
-
-def find_word(board, word, word_to_location):
+    char = word[index]
+    shift = PATH_BITS * index
+    for new_cell, bit in neighbors[cell]:
+        if not visited & bit and letters[new_cell] == char:
+            check_word(letters, neighbors, word, word_to_location, new_cell,
+                       visited | bit, index + 1,
+                       path | (new_cell + 1) << shift)
+
+
+def find_word(board, word, word_to_location, neighbors=None):
     """Locates all possible starting locations of a word within the board."""
-    visited = []
-    for i in range(len(board)):
-        visited.append([False] * len(board))
-    for r, row in enumerate(board):
-        for c, char in enumerate(row):
-            if (char is word[0]):
-                visited[r][c] = True
-                coord_list = []
-                coord_list.append((r, c))
-                check_word(board, word, word_to_location, r, c,
-                           visited, 1, coord_list)
-                visited[r][c] = False
+    if neighbors is None:
+        neighbors = get_neighbors(board)
+    letters = [char for row in board for char in row]
+    for cell, char in enumerate(letters):
+        if (char == word[0]):
+            check_word(letters, neighbors, word, word_to_location, cell,
+                       1 << cell, 1, cell + 1)
+
+
+def build_dawg(words):
+    """Builds a prefix tree of the words, where each node is a dict from a
+    letter to the next node and END marks the end of a word. Equal subtrees
+    are then merged bottom-up, which makes it a minimized DAWG.
+    """
+    root = {}
+    for word in words:
+        node = root
+        for char in word:
+            node = node.setdefault(char, {})
+        node[END] = True
+
+    return minimize_dawg(root, {})
+
+
+def minimize_dawg(node, registry):
+    """Replaces every subtree of node with an equal subtree that has already
+    been seen, if any.
+    """
+    for char in node:
+        if char != END:
+            node[char] = minimize_dawg(node[char], registry)
+
+    key = tuple((char, id(child)) for char, child in sorted(node.items()))
+    return registry.setdefault(key, node)
+
+
+def check_prefix(letters, neighbors, node, word_to_location, cell,
+                 visited, index, path, prefix):
+    """Walks the board and the DAWG together, recording every word that
+    ends along the way.
+    """
+    if instrument.enabled:
+        instrument.count("check_prefix.nodes", index)
+    if END in node:
+        if prefix not in word_to_location:
+            word_to_location[prefix] = []
+        word_to_location[prefix].append(path)
+    shift = PATH_BITS * index
+    for new_cell, bit in neighbors[cell]:
+        char = letters[new_cell]
+        if not visited & bit and char in node:
+            check_prefix(letters, neighbors, node[char], word_to_location,
+                         new_cell, visited | bit, index + 1,
+                         path | (new_cell + 1) << shift, prefix + char)
+
+
+def find_words(board, words, word_to_location):
+    """Locates every word of the list in the board at once. One DFS from each
+    cell walks a DAWG of the words, so words sharing a prefix share the path
+    work. Words are added to word_to_location in the order of the list.
+    """
+    dawg = build_dawg(words)
+    neighbors = get_neighbors(board)
+    letters = [char for row in board for char in row]
+
+    found = {}
+    for cell, char in enumerate(letters):
+        if char in dawg:
+            check_prefix(letters, neighbors, dawg[char], found, cell,
+                         1 << cell, 1, cell + 1, char)
+
+    for word in words:
+        if word in found and word not in word_to_location:
+            word_to_location[word] = found[word]
+
+
+def path_mask(path):
+    """Returns the bitmask of the cells of a path."""
+    mask = 0
+    while path:
+        mask |= 1 << ((path & PATH_MASK) - 1)
+        path >>= PATH_BITS
+    return mask
+
+
+def get_mask_map(word_to_location):
+    """This method maps each word to (mask, ranks) pairs, one per distinct
+    set of cells its paths use. mask has the bit of every cell of the set
+    and ranks are the indexes in word_to_location[word] of the paths that
+    use exactly those cells, so paths that only differ in order are placed
+    once.
+    """
+    word_to_masks = {}
+    for word in word_to_location:
+        groups = {}
+        for rank, path in enumerate(word_to_location[word]):
+            mask = path_mask(path)
+            if mask in groups:
+                groups[mask].append(rank)
+            else:
+                groups[mask] = [rank]
+        word_to_masks[word] = [(mask, tuple(ranks))
+                               for mask, ranks in groups.items()]
+    return word_to_masks
 
 
 def get_length_map(word_to_location):
@@ -503,150 +1089,1153 @@ def get_length_map(word_to_location):
     return length_to_words
 
 
-def frequency_pruning(freqs, lens, length_to_words, index,
-                      pruned_list, cur_words, length_to_index):
-    """A recursive method that determines which set of words are possible
-    given the character count on the board.
+def pack_counts(word):
+    """Packs the letter counts of a word into one int, COUNT_BITS bits per
+    letter.
+    """
+    packed = 0
+    for char in word:
+        packed += 1 << (COUNT_BITS * (ord(char) - ord('A')))
+    return packed
+
+
+def frequency_pruning(remaining, lens, length_to_words, index, cur_words,
+                      length_to_index, dead):
+    """A recursive generator that yields the sets of words that are possible
+    given the character count on the board, as soon as each one is found.
+    remaining is the packed count of the letters left and length_to_words
+    maps each length to (word, packed counts) pairs. Words of the same
+    length are only taken in increasing order, so each combination is tried
+    once. dead maps (index, remaining) to the lowest start index from which
+    that subtree was found to yield nothing, and such subtrees are skipped.
     """
+    if instrument.enabled:
+        instrument.count("frequency_pruning.nodes", index)
     if (index >= len(lens)):
-        new_words = []
-        for word in cur_words:
-            new_words.append(word)
-        pruned_list.append(new_words)
+        yield list(cur_words)
         return
 
-    for i in range(length_to_index[lens[index]],
-                   len(length_to_words[lens[index]])):
-        word = length_to_words[lens[index]][i]
-        valid = True
-        for char in word:
-            freqs[ord(char) - ord('A')] -= 1
-        for char in word:
-            if freqs[ord(char) - ord('A')] < 0:
-                valid = False
-                break
-
-        if valid:
-            cur_words.append(word)
-            before = length_to_index[lens[index]]
-            length_to_index[lens[index]] = i + 1
-            frequency_pruning(freqs, lens, length_to_words, index + 1,
-                              pruned_list, cur_words, length_to_index)
-            length_to_index[lens[index]] = before
-            cur_words.remove(word)
+    length = lens[index]
+    start = length_to_index[length]
+    key = (index, remaining)
+    if dead.get(key, start + 1) <= start:
+        if instrument.enabled:
+            instrument.count("frequency_pruning.memo_hits", index)
+        return
 
-        for char in word:
-            freqs[ord(char) - ord('A')] += 1
+    words = length_to_words[length]
+    guarded = remaining | COUNT_GUARD
+    found = False
+    for i in range(start, len(words)):
+        word, packed = words[i]
+        left = guarded - packed
+        if left & COUNT_GUARD != COUNT_GUARD:
+            if instrument.enabled:
+                instrument.count("frequency_pruning.dead_ends", index)
+            continue
 
+        cur_words.append(word)
+        length_to_index[length] = i + 1
+        for word_list in frequency_pruning(left ^ COUNT_GUARD, lens,
+                                           length_to_words, index + 1,
+                                           cur_words, length_to_index, dead):
+            found = True
+            yield word_list
+        cur_words.pop()
+
+    length_to_index[length] = start
+    if not found:
+        dead[key] = start
+
+
+def non_overlapping_solution(word_list, word_to_masks, index, used,
+                             solution):
+    """A recursive generator that yields every placement of word_list whose
+    cells do not overlap, so that the solution is actually valid, as the
+    list of the ranks of each word's paths that fit. used is the bitmask of
+    the cells taken by the words placed so far.
+    """
+    if instrument.enabled:
+        instrument.count("non_overlapping_solution.nodes", index)
+    if index >= len(word_list):
+        yield list(solution)
+        return
 
-def non_overlapping_solution(word_list, word_to_location, index, prev_set,
-                             solution, solutions):
-    """Returns solutions that contain non-overlapping coordinates such that
-    this solution is actually valid.
+    for mask, ranks in word_to_masks[word_list[index]]:
+        if not used & mask:
+            solution.append(ranks)
+            yield from non_overlapping_solution(word_list, word_to_masks,
+                                                index + 1, used | mask,
+                                                solution)
+            solution.pop()
+        elif instrument.enabled:
+            instrument.count("non_overlapping_solution.dead_ends", index)
+
+
+def place_words(word_list, word_to_location, word_to_masks):
+    """Returns the paths of every non-overlapping placement of word_list,
+    in the order of the ranks of the paths of the first word, then of the
+    second, and so on.
+    """
+    orientations = []
+    for groups in non_overlapping_solution(word_list, word_to_masks, 0, 0,
+                                           []):
+        orientations.extend(itertools.product(*groups))
+    orientations.sort()
+    return [[word_to_location[word][rank]
+             for word, rank in zip(word_list, ranks)]
+            for ranks in orientations]
+
+
+def count_placements(word_list, word_to_masks, index, used, memo):
+    """Returns how many non-overlapping placements of word_list[index:] fit
+    around the cells in used, counting every orientation, without building
+    any of them. memo maps (index, used) to counts already known.
     """
     if index >= len(word_list):
-        new_sol = []
-        for s in solution:
-            new_sol.append(s)
+        return 1
+    key = (index, used)
+    if key in memo:
+        return memo[key]
+
+    total = 0
+    for mask, ranks in word_to_masks[word_list[index]]:
+        if not used & mask:
+            total += len(ranks) * count_placements(word_list, word_to_masks,
+                                                   index + 1, used | mask,
+                                                   memo)
+    memo[key] = total
+    return total
+
+
+def count_iter(board, lens, word_to_location):
+    """Yields (word_list, orientations) for every word list that can be
+    placed, in the order of search_iter, without enumerating the
+    orientations. lens must be sorted in descending order.
+    """
+    word_to_masks = get_mask_map(word_to_location)
+    for word_list in word_sets(board, lens, word_to_location):
+        count = count_placements(word_list, word_to_masks, 0, 0, {})
+        if count:
+            yield word_list, count
+
+
+def packed_words(lens, word_to_location):
+    """Maps every length in lens to the (word, packed counts) pairs of the
+    words of that length, for frequency_pruning.
+    """
+    length_to_words = {length: [] for length in lens}
+    for length, words in get_length_map(word_to_location).items():
+        length_to_words[length] = [(word, pack_counts(word))
+                                   for word in words]
+    return length_to_words
+
+
+def word_sets(board, lens, word_to_location):
+    """Yields the word lists whose letter counts fit the board, one word
+    per length in lens, lazily from frequency_pruning. lens must be sorted
+    in descending order.
+    """
+    length_to_words = packed_words(lens, word_to_location)
+    remaining = pack_counts(char for row in board for char in row
+                            if char != ' ')
+
+    length_to_index = {}
+    for length in set(lens):
+        length_to_index[length] = 0
+
+    yield from frequency_pruning(remaining, lens, length_to_words, 0, [],
+                                 length_to_index, {})
+
+
+def search_iter(board, lens, word_to_location):
+    """Yields (word_list, paths) pairs as they are found. Each word list of
+    word_sets is placed right away with non_overlapping_solution. lens must
+    be sorted in descending order.
+    """
+    word_to_masks = get_mask_map(word_to_location)
+    for word_list in word_sets(board, lens, word_to_location):
+        for paths in place_words(word_list, word_to_location,
+                                 word_to_masks):
+            if instrument.enabled:
+                instrument.count("solutions")
+            yield word_list, paths
+
+
+# The puzzle a worker of parallel_iter is solving. init_branches sets it
+# once per worker, so the tasks do not carry a copy of it.
+_branch_state = None
+
+
+def init_branches(board, lens, word_to_location, cancel):
+    """Runs once in every worker of parallel_iter, forked or spawned, and
+    keeps the puzzle for branch_solutions.
+    """
+    global _branch_state
+    _branch_state = (board, lens, word_to_location, cancel)
+
+
+def branch_solutions(branches):
+    """Runs in a worker of parallel_iter. Returns the (word_list, paths)
+    pairs of every branch, where branch i is the search below the i-th word
+    of the first slot, in the order search_iter finds them.
+    """
+    global _branch_state
+    board, lens, word_to_location, cancel = _branch_state[:4]
+    if len(_branch_state) == 4:
+        # The first task of the worker computes what every branch shares.
+        # dead stays valid across branches, see frequency_pruning.
+        _branch_state = _branch_state + (
+            packed_words(lens, word_to_location),
+            get_mask_map(word_to_location),
+            pack_counts(char for row in board for char in row
+                        if char != ' '),
+            {})
+    length_to_words, word_to_masks, remaining, dead = _branch_state[4:]
+
+    results = []
+    for i in branches:
+        word, packed = length_to_words[lens[0]][i]
+        left = (remaining | COUNT_GUARD) - packed
+        if left & COUNT_GUARD != COUNT_GUARD:
+            continue
+
+        length_to_index = {length: 0 for length in lens}
+        length_to_index[lens[0]] = i + 1
+        for word_list in frequency_pruning(left ^ COUNT_GUARD, lens,
+                                           length_to_words, 1, [word],
+                                           length_to_index, dead):
+            if cancel.is_set():
+                return results
+            for paths in place_words(word_list, word_to_location,
+                                     word_to_masks):
+                results.append((word_list, paths))
+    return results
+
+
+def parallel_iter(board, lens, word_to_location, workers=None):
+    """Works like search_iter, but the branches below each word of the first
+    slot are searched in a pool of processes. Branches are handed out in
+    chunks as workers free up, so one heavy branch does not hold up the
+    rest, and the results are yielded in the order search_iter would yield
+    them. Closing the generator cancels the remaining work.
+    lens must be sorted in descending order.
+    """
+    import concurrent.futures
+    import multiprocessing
+
+    if not lens:
+        return
+
+    # Forked workers get word_to_location without pickling it. Elsewhere
+    # the workers are spawned and init_branches receives a copy.
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+    else:
+        context = multiprocessing.get_context("spawn")
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # Chunks start at one branch so the first results come back soon, grow
+    # to cut the per-task overhead and shrink again as the work runs out.
+    count = len(get_length_map(word_to_location).get(lens[0], []))
+    chunks = []
+    start = 0
+    size = 1
+    while start < count:
+        step = min(size, max(1, (count - start) // (4 * workers)))
+        chunks.append(range(start, start + step))
+        start += step
+        size *= 2
+
+    cancel = context.Event()
+    pool = concurrent.futures.ProcessPoolExecutor(
+        workers, context, initializer=init_branches,
+        initargs=(board, lens, word_to_location, cancel))
+    try:
+        futures = [pool.submit(branch_solutions, chunk) for chunk in chunks]
+        for future in futures:
+            yield from future.result()
+    finally:
+        cancel.set()
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def search_solution(board, lens, word_to_location):
+    """Collects every solution of search_iter into a dict from the string
+    of each word list to the list of its placements.
+    """
+    solutions = {}
+    for word_list, paths in search_iter(board, lens, word_to_location):
         if str(word_list) not in solutions:
             solutions[str(word_list)] = []
-        solutions[str(word_list)].append(new_sol)
+        solutions[str(word_list)].append(paths)
+
+    return solutions
+
+
+def dlx_covers(board, lens, word_to_location):
+    """Solves the puzzle as an exact cover problem with Dancing Links. Every
+    letter of the board is a column, every word length is a column that
+    must be covered once per slot of that length, and every word is a
+    column that may be covered at most once. Each word and distinct set of
+    cells of its paths is a row. Yields each cover as soon as it is found,
+    as a list of (-length, word rank, path ranks, word) rows in slot order,
+    where path ranks are the indexes in word_to_location[word] of the paths
+    over those cells.
+    """
+    length_to_words = get_length_map(word_to_location)
+    word_to_masks = get_mask_map(word_to_location)
+    C = len(board[0])
+
+    cells = [r * C + c for r, row in enumerate(board)
+             for c, char in enumerate(row) if char != ' ']
+    counters = {}
+    for length in lens:
+        counters[("length", length)] = counters.get(("length", length), 0) + 1
+    words = [word for length in sorted(set(lens), reverse=True)
+             for word in length_to_words.get(length, [])]
+
+    problem = ExactCover(cells, [("word", word) for word in words], counters)
+    for length in sorted(set(lens), reverse=True):
+        for rank, word in enumerate(length_to_words.get(length, [])):
+            for mask, ranks in word_to_masks[word]:
+                columns = [cell for cell in cells if mask >> cell & 1]
+                columns.append(("word", word))
+                columns.append(("length", length))
+                problem.add_row(columns, (-length, rank, ranks, word))
+
+    for cover in problem.solve():
+        cover.sort()
+        yield cover
+
+
+def dlx_iter(board, lens, word_to_location):
+    """Yields (word_list, paths) pairs from dlx_covers as they are found,
+    one for every orientation of each cover.
+    """
+    return cover_iter(dlx_covers(board, lens, word_to_location),
+                      word_to_location)
+
+
+def cover_iter(covers, word_to_location):
+    """Yields a (word_list, paths) pair for every orientation of each cover
+    of (-length, word rank, path ranks, word) rows.
+    """
+    for cover in covers:
+        word_list = [row[3] for row in cover]
+        for ranks in itertools.product(*(row[2] for row in cover)):
+            if instrument.enabled:
+                instrument.count("solutions")
+            yield word_list, [word_to_location[word][rank]
+                              for word, rank in zip(word_list, ranks)]
+
+
+def adaptive_rows(board, lens, word_to_location):
+    """Returns the candidates of adaptive_covers as (-length, word rank,
+    path ranks, word) rows, the cell mask and the cells of each, ordered so
+    that words with the letters that are rarest on the board come first
+    and, for each word, the sets of cells that the fewest other candidates
+    also use.
+    """
+    length_to_words = get_length_map(word_to_location)
+    word_to_masks = get_mask_map(word_to_location)
+    letters = [char for row in board for char in row]
+    board_counts = {}
+    for char in letters:
+        if char != ' ':
+            board_counts[char] = board_counts.get(char, 0) + 1
+
+    rows = []
+    for length in sorted(set(lens), reverse=True):
+        for rank, word in enumerate(length_to_words.get(length, [])):
+            for mask, ranks in word_to_masks[word]:
+                cells = tuple(cell for cell in range(len(letters))
+                              if mask >> cell & 1)
+                rows.append(((-length, rank, ranks, word), mask, cells))
+
+    coverage = [0] * len(letters)
+    for row, mask, cells in rows:
+        for cell in cells:
+            coverage[cell] += 1
+
+    def key(candidate):
+        row, mask, cells = candidate
+        rarity = sum(1 / board_counts[char] for char in row[3])
+        return -rarity, sum(coverage[cell] for cell in cells) - len(cells)
+
+    rows.sort(key=key)
+    return rows
+
+
+def get_regions(board):
+    """Returns what split_regions needs to know about the board: the number
+    of columns and the masks of the cells not in the first and not in the
+    last column.
+    """
+    C = len(board[0])
+    not_first = 0
+    not_last = 0
+    for r in range(len(board)):
+        for c in range(C):
+            if c > 0:
+                not_first |= 1 << (r * C + c)
+            if c < C - 1:
+                not_last |= 1 << (r * C + c)
+    return C, not_first, not_last
+
+
+def grow_cells(regions, cells):
+    """Returns the bitmask cells together with the 8 neighbours of each of
+    its cells.
+    """
+    C, not_first, not_last = regions
+    right = cells << 1 | cells << (C + 1) | cells >> (C - 1)
+    left = cells >> 1 | cells >> (C + 1) | cells << (C - 1)
+    return (cells | cells << C | cells >> C |
+            right & not_first | left & not_last)
+
+
+def split_regions(regions, free, seeds=None):
+    """Splits the free cells into 8-connected regions with bitmask flood
+    fills and returns the bitmask of each region. Every region has to hold
+    one of seeds, all of free by default, so a flood fill stops as soon as
+    its region holds every seed left: the rest of free is that region too.
+    """
+    if seeds is None:
+        seeds = free
+    areas = []
+    while free:
+        region = seeds & -seeds
+        while seeds & ~region:
+            grown = grow_cells(regions, region) & free
+            if grown == region:
+                break
+            region = grown
+        else:
+            areas.append(free)
+            break
+        areas.append(region)
+        free &= ~region
+        seeds &= ~region
+    return areas
+
+
+def fill_regions(capacity, lengths, index):
+    """Checks if lengths[index:], sorted in descending order, can be shared
+    out among the regions so that none is overfilled. capacity holds the
+    number of cells each region has left.
+    """
+    if index >= len(lengths):
+        return True
+    length = lengths[index]
+    tried = set()
+    for k, left in enumerate(capacity):
+        if left >= length and left not in tried:
+            tried.add(left)
+            capacity[k] -= length
+            fits = fill_regions(capacity, lengths, index + 1)
+            capacity[k] += length
+            if fits:
+                return True
+    return False
+
+
+def place_in_regions(regions, areas, mask, slots):
+    """Returns the regions of free cells once the cells of mask are taken,
+    or None if the words still needed by slots cannot fill every region
+    exactly. A word is a connected path, so mask lies in a single region
+    and only that one is split again, seeded with the free cells next to
+    the word. No word can span two regions either.
+    """
+    for k, area in enumerate(areas):
+        if area & mask:
+            break
+    rest = area & ~mask
+    areas = (areas[:k] +
+             split_regions(regions, rest, grow_cells(regions, mask) & rest) +
+             areas[k + 1:])
+    if len(areas) > 1:
+        lengths = sorted((length for length, need in slots.items()
+                          for _ in range(need)), reverse=True)
+        sizes = [bin(area).count("1") for area in areas]
+        if (sum(sizes) != sum(lengths) or
+                not fill_regions(sizes, lengths, 0)):
+            return None
+    return areas
+
+
+def adaptive_search(rows, live, free, slots, cover, regions, areas):
+    """A recursive generator that yields every cover reachable from the
+    live candidates, the indexes in rows of the candidates that only use
+    cells in the free mask and are still allowed. slots maps each length to
+    the number of words of that length still needed. Every node branches on
+    whatever has the fewest live candidates: a free cell, which exactly one
+    of them must cover, or a slot length. For a slot, the k-th candidate is
+    only tried without the ones before it, so no set of words is found
+    twice. areas are the 8-connected regions of the free cells, and a
+    candidate that leaves regions the needed words cannot fill exactly is
+    cut before its node is built, see place_in_regions.
+    """
+    depth = len(cover)
+    if instrument.enabled:
+        instrument.count("adaptive.nodes", depth)
+    if not any(slots.values()):
+        if not free:
+            yield list(cover)
+        return
+
+    by_length = {}
+    by_cell = {}
+    for i in live:
+        row, mask, cells = rows[i]
+        by_length.setdefault(-row[0], []).append(i)
+        for cell in cells:
+            by_cell.setdefault(cell, []).append(i)
+
+    best = None
+    for length, need in slots.items():
+        if need:
+            candidates = by_length.get(length, [])
+            if len(candidates) < need:
+                best = []
+                break
+            if best is None or len(candidates) < len(best):
+                best, slot = candidates, length
+    cells_left = free
+    while best and cells_left:
+        cell = (cells_left & -cells_left).bit_length() - 1
+        cells_left &= cells_left - 1
+        candidates = by_cell.get(cell, [])
+        if len(candidates) < len(best):
+            best, slot = candidates, None
+
+    if not best:
+        if instrument.enabled:
+            instrument.count("adaptive.dead_ends", depth)
         return
 
-    for locations in word_to_location[word_list[index]]:
-        new_set = prev_set.union(set(locations))
-        if len(new_set) is len(prev_set) + len(locations):
-            solution.append(locations)
-            non_overlapping_solution(word_list, word_to_location, index + 1,
-                                     new_set, solution, solutions)
-            solution.remove(locations)
+    skipped = set()
+    for i in best:
+        row, mask, cells = rows[i]
+        length = -row[0]
+        slots[length] -= 1
+        done = slots[length] == 0
+        word = row[3]
+        next_areas = place_in_regions(regions, areas, mask, slots)
+        if next_areas is not None:
+            rest = [j for j in live
+                    if not rows[j][1] & mask and j not in skipped and
+                    rows[j][0][3] != word and
+                    not (done and rows[j][0][0] == row[0])]
+            cover.append(row)
+            yield from adaptive_search(rows, rest, free & ~mask, slots,
+                                       cover, regions, next_areas)
+            cover.pop()
+        elif instrument.enabled:
+            instrument.count("adaptive.regions_cut", depth)
+        slots[length] += 1
+        if slot is not None:
+            skipped.add(i)
+
+
+def adaptive_covers(board, lens, word_to_location):
+    """Finds the same covers as dlx_covers with a search that fills the
+    most constrained free cell or word length first, see adaptive_search.
+    The candidate lists shrink as cells are used, and the candidates are
+    tried in the order of adaptive_rows. Yields each cover as soon as it is
+    found, in slot order.
+    """
+    rows = adaptive_rows(board, lens, word_to_location)
+    C = len(board[0])
+    free = 0
+    for r, row in enumerate(board):
+        for c, char in enumerate(row):
+            if char != ' ':
+                free |= 1 << (r * C + c)
+    slots = {}
+    for length in lens:
+        slots[length] = slots.get(length, 0) + 1
+    regions = get_regions(board)
+    for cover in adaptive_search(rows, list(range(len(rows))), free, slots,
+                                 [], regions, split_regions(regions, free)):
+        cover.sort()
+        yield cover
+
+
+def dlx_solution(board, lens, word_to_location):
+    """Collects every cover of dlx_covers into the same solutions dict as
+    search_solution, in the same order.
+    """
+    return cover_solution(dlx_covers(board, lens, word_to_location),
+                          word_to_location)
 
 
-def main():
-    start = time.time()
-    file_name = sys.argv[1]
-    lens = []
-    lens_set = set()
-    board = []
-    board, pixel_to_rc, lens = get_input("puzzles/" + file_name + ".PNG")
+def adaptive_solution(board, lens, word_to_location):
+    """Collects every cover of adaptive_covers into the same solutions dict
+    as search_solution, in the same order.
+    """
+    return cover_solution(adaptive_covers(board, lens, word_to_location),
+                          word_to_location)
 
-    end = time.time()
-    print("Loaded in %.2f seconds\n" % (end-start))
 
-    start = time.time()
+def cover_solution(covers, word_to_location):
+    """Collects the covers of dlx_covers or adaptive_covers into the same
+    solutions dict as search_solution, in the same order.
+    """
+    # Sort the covers the way frequency_pruning and
+    # non_overlapping_solution would find them.
+    found = {}
+    for cover in covers:
+        key = tuple(row[:2] for row in cover)
+        word_list = [row[3] for row in cover]
+        if key not in found:
+            found[key] = (word_list, [])
+        for ranks in itertools.product(*(row[2] for row in cover)):
+            found[key][1].append((ranks, [
+                word_to_location[word][rank]
+                for word, rank in zip(word_list, ranks)]))
 
-    print("solving puzzle...")
-    print("[", end="", flush=True)
+    solutions = {}
+    for key in sorted(found):
+        word_list, orientations = found[key]
+        orientations.sort()
+        solutions[str(word_list)] = [paths for key, paths in orientations]
 
-    lens_set = set(lens)
-    lens.sort(reverse=True)
-    pruned_list = triplet_prune(board, lens)
+    return solutions
 
-    print("S", end="", flush=True)
 
+def locate_words(board, lens, search="trie", dictionary=None):
+    """Returns word_to_location for the dictionary words of the given
+    lengths that survive triplet_prune and can be found in the board.
+    """
+    with instrument.stage("triplet_prune"):
+        pruned_list = triplet_prune(board, lens, dictionary)
     word_to_location = {}
-    for word in pruned_list:
-        find_word(board, word, word_to_location)
+    if search == "trie":
+        with instrument.stage("find_words"):
+            find_words(board, pruned_list, word_to_location)
+    else:
+        with instrument.stage("find_word"):
+            neighbors = get_neighbors(board)
+            for word in pruned_list:
+                find_word(board, word, word_to_location, neighbors)
+
+    if instrument.enabled:
+        for word in word_to_location:
+            instrument.count("locate.words", len(word))
+            instrument.count("locate.paths", len(word),
+                             len(word_to_location[word]))
+            instrument.maximum("locate.max_paths",
+                               len(word_to_location[word]))
+
+    return word_to_location
+
+
+def solution_iter(board, lens, word_to_location, solver="search",
+                  workers=None):
+    """Yields (word_list, paths) pairs from the chosen solver as they are
+    found. With workers, the search solver runs in that many processes.
+    lens must be sorted in descending order.
+    """
+    if solver == "dlx":
+        return dlx_iter(board, lens, word_to_location)
+    if solver == "adaptive":
+        return cover_iter(adaptive_covers(board, lens, word_to_location),
+                          word_to_location)
+    if workers is not None:
+        return parallel_iter(board, lens, word_to_location, workers)
+    return search_iter(board, lens, word_to_location)
+
+
+def fallback_iter(board, lens, search="trie", solver="search", workers=None,
+                  word_lists=WORD_LISTS, count=False):
+    """Yields the solutions of the first word list that has any, trying the
+    lists in order, e.g. a short list of common words before the full one.
+    With count, yields the (word_list, orientations) pairs of count_iter
+    instead. lens must be sorted in descending order.
+    """
+    for name in word_lists:
+        with instrument.stage("locate"):
+            word_to_location = locate_words(board, lens, search,
+                                            open_dictionary(name))
+        if count:
+            solutions = count_iter(board, lens, word_to_location)
+        else:
+            solutions = solution_iter(board, lens, word_to_location, solver,
+                                      workers)
+        found = False
+        for solution in solutions:
+            found = True
+            yield solution
+        if found:
+            return
+
+
+def solve_iter(board, lens, search="trie", solver="search", workers=None,
+               word_lists=WORD_LISTS):
+    """Solves a board and yields each solution as soon as it is found, as a
+    (word_list, paths) pair. Paths are ints that decode_path turns into
+    (r, c) tuples. The word lists are tried in order until one of them
+    solves the board.
+    """
+    lens = sorted(lens, reverse=True)
+    yield from fallback_iter(board, lens, search, solver, workers, word_lists)
 
-    print("O", end="", flush=True)
 
-    length_to_words = get_length_map(word_to_location)
+class Session:
+    """Holds the located words of a board so that words can be locked in
+    one at a time and the rest solved again, without touching the
+    dictionary or locating any words again.
 
-    print("L", end="", flush=True)
+        session = Session(board, lens)
+        session.place("PLEAD", [(0, 1), (0, 2), (1, 2), (2, 2), (2, 3)])
+        for word_list, paths in session.solve_iter():
+            ...
+        session.undo()
 
-    freqs = []
-    for i in range(26):
-        freqs.append(0)
+    Every placement filters the index of the previous one down to the paths
+    that avoid its cells, and undo goes back to the previous index.
+    """
 
-    print("V", end="", flush=True)
+    def __init__(self, board, lens, search="trie", dictionary=None,
+                 word_to_location=None):
+        self.board = board
+        self.lens = sorted(lens, reverse=True)
+        if word_to_location is None:
+            word_to_location = locate_words(board, self.lens, search,
+                                            dictionary)
+        self.C = len(board[0])
+        self.placed = []
+        # One (used, lens, word_to_location, word_to_bits) level per
+        # placement, where word_to_bits has the cell mask of every path.
+        word_to_bits = {word: [path_mask(path) for path in paths]
+                        for word, paths in word_to_location.items()}
+        self.levels = [(0, self.lens, word_to_location, word_to_bits)]
+
+    def place(self, word, cells):
+        """Locks in word on cells, given as a list of (r, c) tuples or as a
+        path int. Raises ValueError if the word does not fit there.
+        """
+        used, lens, word_to_location, word_to_bits = self.levels[-1]
+        path = cells if isinstance(cells, int) else encode_path(cells, self.C)
+        if len(word) not in lens:
+            raise ValueError("no slot of length %d is left for %s" %
+                             (len(word), word))
+        if path not in word_to_location.get(word, []):
+            raise ValueError("%s is not a path of %s on the free cells" %
+                             (decode_path(path, self.C), word))
+
+        used |= path_mask(path)
+        lens = list(lens)
+        lens.remove(len(word))
+        new_location = {}
+        new_bits = {}
+        for other, paths in word_to_location.items():
+            if other == word or len(other) not in lens:
+                continue
+            kept = [i for i, bits in enumerate(word_to_bits[other])
+                    if not bits & used]
+            if kept:
+                new_location[other] = [paths[i] for i in kept]
+                new_bits[other] = [word_to_bits[other][i] for i in kept]
+
+        self.placed.append((word, path))
+        self.levels.append((used, lens, new_location, new_bits))
+
+    def undo(self):
+        """Takes back the last placement and returns its (word, path)."""
+        if not self.placed:
+            raise ValueError("no word has been placed")
+        self.levels.pop()
+        return self.placed.pop()
+
+    def remaining(self):
+        """Returns (board, lens, word_to_location) of the part that is left,
+        with the placed cells blanked out of the board.
+        """
+        used, lens, word_to_location, word_to_bits = self.levels[-1]
+        board = [[' ' if used >> (r * self.C + c) & 1 else char
+                  for c, char in enumerate(row)]
+                 for r, row in enumerate(self.board)]
+        return board, lens, word_to_location
+
+    def solve_iter(self, solver="search", workers=None):
+        """Yields the (word_list, paths) pairs that fill the rest of the
+        board, like solution_iter. The placed words are not included.
+        """
+        board, lens, word_to_location = self.remaining()
+        if not lens:
+            yield [], []
+            return
+        yield from solution_iter(board, lens, word_to_location, solver,
+                                 workers)
+
+
+def format_solution(board, solution):
+    """Returns the board with the cells of each word labelled by the letter
+    of the word and the position in it.
+    """
+    new_board = [["   "] * len(board[0]) for row in board]
+    for index, path in enumerate(solution):
+        for i, (r, c) in enumerate(decode_path(path, len(board[0]))):
+            new_board[r][c] = "%c%-2d" % (ord("A") + index, i + 1)
 
-    for row in board:
-        for char in row:
-            if (char != ' '):
-                freqs[ord(char) - ord('A')] += 1
+    return format_board(new_board, "\t")
 
-    print("I", end="", flush=True)
 
-    pruned_list = []
-    length_to_index = {}
-    for length in lens_set:
-        length_to_index[length] = 0
+class SolutionWriter:
+    """Writes solutions to a stream. Each solution is rendered into one
+    buffer and written and flushed in one call as soon as it is complete,
+    so the output streams while the search runs without one write per
+    cell.
 
-    frequency_pruning(freqs, lens, length_to_words, 0,
-                      pruned_list, [], length_to_index)
+    fmt is "text" for the boards of format_solution, "json" for one JSON
+    object per line, {"words": [...], "paths": [[[r, c], ...], ...]}, or
+    "binary" for the records of binary_record. show is "all" for every
+    orientation, "first" for the first orientation of each word set, or
+    "sets" for the word sets only, without paths.
+    """
 
-    print("N", end="", flush=True)
+    def __init__(self, stream, board, fmt="text", show="all"):
+        self.board = board
+        self.C = len(board[0])
+        self.fmt = fmt
+        self.show = show
+        if fmt == "binary":
+            self.stream = getattr(stream, "buffer", stream)
+        else:
+            self.stream = stream
+        self.parts = []
+        self.last_words = None
+        if fmt == "binary":
+            self.write(bytes((*BINARY_MAGIC, len(board), self.C,
+                              show != "sets")))
+
+    def write(self, data):
+        """Adds text, or bytes in binary format, to the buffer."""
+        self.parts.append(data)
+
+    def flush(self):
+        """Writes out the buffer in one call."""
+        if self.parts:
+            empty = b"" if self.fmt == "binary" else ""
+            self.stream.write(empty.join(self.parts))
+            self.parts = []
+        self.stream.flush()
+
+    def solution(self, word_list, paths, new_set):
+        """Writes one orientation of word_list, new_set when it is the
+        first one of its word set, and flushes it before control goes back
+        to the search. Returns whether anything was written. The cover
+        solvers can come back to a word set later, so the text heading is
+        repeated whenever the word set differs from the one written last.
+        """
+        if not new_set and self.show != "all":
+            return False
+        if self.fmt == "binary":
+            if self.show == "sets":
+                paths = None
+            self.write(binary_record(word_list, paths))
+        elif self.fmt == "json":
+            record = {"words": word_list}
+            if self.show != "sets":
+                record["paths"] = [decode_path(path, self.C)
+                                   for path in paths]
+            self.write(json.dumps(record, separators=(",", ":")) + "\n")
+        else:
+            if word_list != self.last_words:
+                self.write("\nWe found this solution:  %s\n" % word_list)
+                if self.show != "sets":
+                    self.write("With these orientations: \n")
+            if self.show != "sets":
+                self.write(format_solution(self.board, paths))
+        self.last_words = word_list
+        self.flush()
+        return True
+
+    def count(self, word_list, orientations):
+        """Writes the number of orientations of word_list, for --count, as
+        text or as a JSON object {"words": [...], "orientations": n}.
+        """
+        if self.fmt == "json":
+            self.write(json.dumps({"words": word_list,
+                                   "orientations": orientations},
+                                  separators=(",", ":")) + "\n")
+        else:
+            self.write("%s: %d orientations\n" % (word_list, orientations))
+        self.flush()
+
+    def close(self):
+        """Flushes what is left."""
+        self.flush()
+
+
+# The first bytes of the binary output of SolutionWriter.
+BINARY_MAGIC = b"WBS1"
+
+
+def binary_record(word_list, paths=None):
+    """Returns one solution as bytes: the number of words, then for each
+    word its length, its letters and, with paths, the r * C + c cell of
+    each letter.
+    """
+    record = bytearray((len(word_list),))
+    for k, word in enumerate(word_list):
+        record.append(len(word))
+        record += word.encode("ascii")
+        if paths is not None:
+            path = paths[k]
+            while path:
+                record.append((path & PATH_MASK) - 1)
+                path >>= PATH_BITS
+    return bytes(record)
+
+
+def read_binary(data):
+    """Yields (word_list, paths) pairs from the binary output of
+    SolutionWriter, with paths as lists of (r, c) tuples, or None when the
+    output has the word sets only.
+    """
+    if data[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+        raise ValueError("not a binary solution stream")
+    R, C, has_paths = data[len(BINARY_MAGIC):len(BINARY_MAGIC) + 3]
+    i = len(BINARY_MAGIC) + 3
+    while i < len(data):
+        count = data[i]
+        i += 1
+        word_list = []
+        paths = [] if has_paths else None
+        for k in range(count):
+            length = data[i]
+            word_list.append(data[i + 1:i + 1 + length].decode("ascii"))
+            i += 1 + length
+            if has_paths:
+                paths.append([divmod(cell, C) for cell in
+                              data[i:i + length]])
+                i += length
+        yield word_list, paths
+
+
+def parse_args(argv=None):
+    """Parses the command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Solves a WordBubbles! puzzle from a screenshot.")
+    parser.add_argument("file_name", nargs="?",
+                        help="name of the image in puzzles/, e.g. IMG_01")
+    parser.add_argument("--board", metavar="FILE",
+                        help="solve a board given as text or JSON instead "
+                        "of an image, - for stdin. The image is not "
+                        "decoded and PIL is not imported")
+    parser.add_argument("--search", choices=("trie", "word"), default="trie",
+                        help="find all words with one DAWG walk of the board "
+                        "(trie) or with one DFS per word (word)")
+    parser.add_argument("--solver", choices=("search", "dlx", "adaptive"),
+                        default="search",
+                        help="place the words with letter count pruning and "
+                        "backtracking (search), as an exact cover problem "
+                        "with Dancing Links (dlx) or by filling the most "
+                        "constrained cell or word length first (adaptive)")
+    parser.add_argument("--words", action="append", metavar="FILE",
+                        help="word list to solve with, default %s. Repeat "
+                        "it to try several lists in order until one solves "
+                        "the board" % WORD_LISTS[0])
+    parser.add_argument("--workers", type=int, metavar="N",
+                        help="split the search solver over N processes by "
+                        "the word in the first slot")
+    parser.add_argument("--count", action="store_true",
+                        help="only count the word sets and the orientations "
+                        "of each instead of printing them")
+    parser.add_argument("--first", action="store_true",
+                        help="stop after the first solution")
+    parser.add_argument("--limit", type=int, metavar="N",
+                        help="stop after N solutions. With --check-unique "
+                        "only N are written, but the search goes on until "
+                        "the answer is known")
+    parser.add_argument("--check-unique", action="store_true",
+                        help="stop as soon as a second set of words is "
+                        "found and report whether the answer is unique")
+    parser.add_argument("--format", choices=("text", "json", "binary"),
+                        default="text",
+                        help="write the solutions as labelled boards (text), "
+                        "one JSON object per line (json) or binary records "
+                        "(binary). With json and binary everything else "
+                        "goes to stderr")
+    parser.add_argument("--show", choices=("all", "first", "sets"),
+                        default="all",
+                        help="write every orientation (all), the first "
+                        "orientation of each word set (first) or only the "
+                        "word sets (sets). --first and --limit count what "
+                        "is written")
+    parser.add_argument("--glyphs", choices=("template", "rules"),
+                        default=GLYPHS,
+                        help="read the letters by matching them against the "
+                        "templates in glyphs.json (template) or with the "
+                        "get_letter rules (rules)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="always parse the image instead of looking the "
+                        "board up in %s/" % BOARD_CACHE)
+    parser.add_argument("--profile", action="store_true",
+                        help="time every stage, count the search nodes and "
+                        "trace peak memory, and print the report as JSON to "
+                        "stderr (also WORDPOPPER_PROFILE=1)")
+    parser.add_argument("--profile-json", metavar="FILE",
+                        help="write the --profile report to FILE instead")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="write the stages as a Chrome trace-event file")
+    parser.add_argument("--cprofile", metavar="FILE",
+                        help="run under cProfile and dump the pstats to FILE")
+    args = parser.parse_args(argv)
+    if (args.file_name is None) == (args.board is None):
+        parser.error("give either the name of an image or --board")
+    if args.limit is not None and args.limit < 1:
+        parser.error("--limit must be at least 1")
+    if args.count:
+        # Counting never builds the orientations, which only the search
+        # solver can skip.
+        if args.solver != "search" or args.workers is not None:
+            parser.error("--count only works with the search solver in one "
+                         "process")
+        if args.check_unique or args.show != "all":
+            parser.error("--count cannot be combined with --check-unique or "
+                         "--show")
+        if args.format == "binary":
+            parser.error("--count writes text or json")
+    return args
+
+
+def run(args, out=None):
+    """Solves the puzzle named on the command line and prints the board and
+    the solutions. The solutions are written to out, stdout by default,
+    through a SolutionWriter.
+    """
+    if out is None:
+        out = sys.stdout
+    start = time.time()
+    file_name = args.file_name
+    with instrument.stage("parse"):
+        if args.board:
+            try:
+                board, lens = read_board(args.board)
+            except ValueError as e:
+                sys.exit("solve.py: error: %s" % e)
+            print("This is the board:")
+            print_board(board, "\t")
+        elif args.no_cache:
+            board, pixel_to_rc, lens = get_input(
+                "puzzles/" + file_name + ".PNG", args.glyphs)
+        else:
+            board, pixel_to_rc, lens = get_cached_input(
+                "puzzles/" + file_name + ".PNG", glyphs=args.glyphs)
 
     end = time.time()
-    solutions = {}
-    for p in pruned_list:
-        non_overlapping_solution(p, word_to_location, 0, set(), [], solutions)
-
-    print("']")
-
-    for word_list in solutions:
-        print("\nWe found this solution: ", word_list)
-        print("With these orientations: ")
-        for solution in solutions[word_list]:
-            index = 0
-            new_board = []
-            for i in range(len(board)):
-                new_board.append(["   "] * len(board[0]))
-
-            for tuples in solution:
-                for i, t in enumerate(tuples):
-                    if i + 1 > 9:
-                        new_board[t[0]][t[1]] = chr(ord("A") + index)\
-                         + str(i+1)
-                    else:
-                        new_board[t[0]][t[1]] = chr(ord("A") + index)\
-                         + str(i+1) + " "
-                index += 1
-
-            print_board(new_board, "\t")
+    print("Loaded in %.2f seconds\n" % (end-start))
+
+    start = time.time()
+
+    print("solving puzzle...")
+    print("[", end="", flush=True)
+
+    lens.sort(reverse=True)
+    word_lists = args.words or WORD_LISTS
+
+    print("SO", end="", flush=True)
+    print("LVIN']", flush=True)
+
+    limit = args.limit
+    if args.first:
+        limit = 1
+
+    if args.count:
+        count = 0
+        total = 0
+        writer = SolutionWriter(out, board, args.format)
+        counts = fallback_iter(board, lens, args.search,
+                               word_lists=word_lists, count=True)
+        with instrument.stage("solve"):
+            for word_list, orientations in counts:
+                writer.count(word_list, orientations)
+                count += 1
+                total += orientations
+                if limit is not None and count >= limit:
+                    break
+        counts.close()
+        writer.close()
+        print("\n%d word sets, %d orientations" % (count, total))
+        print("Solved in %.2f seconds" % (time.time() - start))
+        return
+
+    count = 0
+    # The cover solvers do not find the orientations of a word set one
+    # after the other, so a set counts as new only the first time.
+    seen = set()
+    writer = SolutionWriter(out, board, args.format, args.show)
+    solutions = fallback_iter(board, lens, args.search, args.solver,
+                              args.workers, word_lists)
+    with instrument.stage("solve"):
+        for word_list, paths in solutions:
+            new_set = tuple(word_list) not in seen
+            if new_set:
+                if not seen:
+                    print("First solution in %.2f seconds" %
+                          (time.time() - start), flush=True)
+                seen.add(tuple(word_list))
+                if args.check_unique and len(seen) > 1:
+                    writer.flush()
+                    print("\nWe found another solution: ", str(word_list))
+                    break
+
+            # With --check-unique the search goes on past the limit, without
+            # writing, until a second word set shows up or there is none.
+            if limit is None or count < limit:
+                if writer.solution(word_list, paths, new_set):
+                    count += 1
+            if (limit is not None and count >= limit and
+                    not args.check_unique):
+                break
+    # Stops the workers of a parallel search right away.
+    solutions.close()
+    writer.close()
+
+    if args.check_unique:
+        if len(seen) == 1:
+            print("\nThe solution is unique.")
+        elif not seen:
+            print("\nThere is no solution.")
+        else:
+            print("\nThe solution is not unique.")
 
     end = time.time()
     print("Solved in %.2f seconds" % (end-start))
 
+
+def main():
+    args = parse_args()
+    if args.profile or args.profile_json or args.trace:
+        instrument.enable()
+    profiler = None
+    if args.cprofile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    if args.format == "text":
+        run(args)
+    else:
+        # Keep stdout for the solutions.
+        out = sys.stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            run(args, out)
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.cprofile)
+    if args.trace:
+        instrument.write_trace(args.trace)
+    if args.profile_json:
+        instrument.write_report(args.profile_json)
+    elif instrument.enabled:
+        print(json.dumps(instrument.report(), indent=1), file=sys.stderr)
+
 if __name__ == '__main__':
     main()
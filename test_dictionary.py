@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Tests for compiling word lists:
+`python3 -m pytest test_dictionary.py`
+"""
+
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+import dictionary
+
+
+class TestCompileDictionary(unittest.TestCase):
+
+    def test_skips_words_that_are_not_a_to_z(self):
+        with tempfile.TemporaryDirectory() as directory:
+            name = os.path.join(directory, "words.txt")
+            with open(name, "wb") as f:
+                f.write("cat\ndon't\ncafé\ndog\nTAco\n\n".encode())
+            errors = io.StringIO()
+            with contextlib.redirect_stderr(errors):
+                words = dictionary.Dictionary(name)
+            self.assertEqual(words.words(3), ["CAT", "DOG"])
+            self.assertEqual(words.words(4), ["TACO"])
+            self.assertIn("skipped 2 words", errors.getvalue())
+            self.assertTrue(dictionary.is_fresh(name,
+                                                dictionary.cache_name(name)))
+            words.data.close()
+
+    def test_words_across_chunks(self):
+        with tempfile.TemporaryDirectory() as directory:
+            name = os.path.join(directory, "words.txt")
+            with open(name, "w") as f:
+                f.write("alpha beta\ngamma")
+            self.assertEqual(list(dictionary.read_words(name, 3)),
+                             [b"ALPHA", b"BETA", b"GAMMA"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Tests for the parts of solve.py that do not need the images:
+`python3 -m pytest test_solve.py`
+"""
+
+import contextlib
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import solve
+
+
+BOARD = [list("AB"), list("CD")]
+
+# The board of puzzles/IMG_04.PNG, which has five word sets.
+IMG_04 = {"board": ["YSTIJVE", "AMLNEUG", " TMAARD", "RERTTER", "YYOJROG",
+                    "G OAUHI", "OLRTSWE"],
+          "lens": [10, 9, 9, 5, 5, 5, 4]}
+
+
+class TestSolutionWriter(unittest.TestCase):
+
+    def test_solution_is_written_before_the_search_goes_on(self):
+        stream = io.StringIO()
+        writer = solve.SolutionWriter(stream, BOARD)
+        seen = []
+
+        def slow_solutions():
+            yield ["AB", "CD"], [1 | 2 << 8, 3 | 4 << 8]
+            # The search is busy with the next solution here, and the
+            # first one must already be out.
+            seen.append(stream.getvalue())
+            time.sleep(0.2)
+            yield ["AC", "BD"], [1 | 3 << 8, 2 | 4 << 8]
+
+        new_set = True
+        for word_list, paths in slow_solutions():
+            writer.solution(word_list, paths, new_set)
+        writer.close()
+
+        self.assertIn("['AB', 'CD']", seen[0])
+        self.assertIn("| A1  A2  |", seen[0])
+        self.assertIn("['AC', 'BD']", stream.getvalue())
+
+    def test_binary_round_trip(self):
+        stream = io.BytesIO()
+        writer = solve.SolutionWriter(stream, BOARD, "binary")
+        writer.solution(["AB", "CD"], [1 | 2 << 8, 3 | 4 << 8], True)
+        writer.close()
+        self.assertEqual(list(solve.read_binary(stream.getvalue())),
+                         [(["AB", "CD"], [[(0, 0), (0, 1)],
+                                          [(1, 0), (1, 1)]])])
+
+
+class TestRun(unittest.TestCase):
+
+    def run_solve(self, *argv):
+        """Runs solve.py on IMG_04 and returns what it writes to out."""
+        with tempfile.NamedTemporaryFile("w", suffix=".json",
+                                         delete=False) as f:
+            json.dump(IMG_04, f)
+        self.addCleanup(os.remove, f.name)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(io.StringIO()):
+            solve.run(solve.parse_args(["--board", f.name] + list(argv)),
+                      out)
+        return out.getvalue().splitlines()
+
+    def headings(self, *argv):
+        return [line for line in self.run_solve(*argv)
+                if line.startswith("We found this solution")]
+
+    def test_each_word_set_is_shown_once_by_every_solver(self):
+        for solver in ("search", "dlx", "adaptive"):
+            sets = self.headings("--solver", solver, "--show", "sets")
+            self.assertEqual(len(sets), 5, solver)
+            self.assertEqual(len(set(sets)), 5, solver)
+
+    def test_count_as_json(self):
+        counts = [json.loads(line) for line in
+                  self.run_solve("--count", "--format", "json", "--limit",
+                                 "2")]
+        self.assertEqual(len(counts), 2)
+        self.assertEqual(counts[0]["words"][0], "VENTILATOR")
+        self.assertGreater(counts[0]["orientations"], 0)
+
+    def test_limit_counts_word_sets_once(self):
+        sets = self.headings("--solver", "dlx", "--show", "first",
+                              "--limit", "6")
+        self.assertEqual(len(sets), 5)
+        self.assertEqual(len(set(sets)), 5)
+
+
+class TestParallel(unittest.TestCase):
+
+    def test_spawned_workers_get_the_puzzle(self):
+        board, lens = solve.parse_board(IMG_04["board"], IMG_04["lens"])
+        lens.sort(reverse=True)
+        word_to_location = solve.locate_words(board, lens)
+        expected = list(solve.search_iter(board, lens, word_to_location))
+        with mock.patch("multiprocessing.get_all_start_methods",
+                        return_value=["spawn"]):
+            self.assertEqual(
+                list(solve.parallel_iter(board, lens, word_to_location, 2)),
+                expected)
+
+
+class TestSession(unittest.TestCase):
+
+    def setUp(self):
+        board = [list("CAT"), list("DOG")]
+        cells = {"CAT": [(0, 0), (0, 1), (0, 2)],
+                 "DOG": [(1, 0), (1, 1), (1, 2)],
+                 "COD": [(0, 0), (1, 1), (1, 0)],
+                 "TAG": [(0, 2), (0, 1), (1, 2)]}
+        self.paths = {word: solve.encode_path(path, 3)
+                      for word, path in cells.items()}
+        self.session = solve.Session(
+            board, [3, 3], word_to_location={
+                word: [path] for word, path in self.paths.items()})
+
+    def test_place_and_solve_the_rest(self):
+        self.session.place("CAT", [(0, 0), (0, 1), (0, 2)])
+        self.assertEqual(list(self.session.solve_iter()),
+                         [(["DOG"], [self.paths["DOG"]])])
+
+    def test_undo_restores_the_index(self):
+        before = list(self.session.solve_iter())
+        self.assertEqual(len(before), 2)
+        self.session.place("COD", self.paths["COD"])
+        self.assertEqual(self.session.remaining()[2],
+                         {"TAG": [self.paths["TAG"]]})
+        self.assertEqual(self.session.undo(), ("COD", self.paths["COD"]))
+        self.assertEqual(list(self.session.solve_iter()), before)
+        with self.assertRaises(ValueError):
+            self.session.undo()
+
+    def test_every_slot_filled(self):
+        self.session.place("COD", self.paths["COD"])
+        self.session.place("TAG", self.paths["TAG"])
+        self.assertEqual(list(self.session.solve_iter()), [([], [])])
+        with self.assertRaises(ValueError):
+            self.session.place("DOG", self.paths["DOG"])
+
+    def test_rejects_a_wrong_path(self):
+        with self.assertRaises(ValueError):
+            self.session.place("CAT", [(1, 0), (1, 1), (1, 2)])
+        self.session.place("COD", self.paths["COD"])
+        # CAT is a path of the board, but COD took its first cell.
+        with self.assertRaises(ValueError):
+            self.session.place("CAT", self.paths["CAT"])
+
+
+class TestParseBoard(unittest.TestCase):
+
+    def test_blanks_and_case(self):
+        self.assertEqual(solve.parse_board(["ab", "c."], [3]),
+                         ([["A", "B"], ["C", " "]], [3]))
+
+    def test_rejects_malformed_boards(self):
+        for rows in ([], ["ABC", "D"], ["", ""], ["A1"], "AB"):
+            with self.assertRaises(ValueError):
+                solve.parse_board(rows, [2])
+        with self.assertRaises(ValueError):
+            solve.parse_board(["AB"], [0])
+
+    def test_lengths_must_add_up_to_the_letters(self):
+        with self.assertRaises(ValueError):
+            solve.parse_board(["CAT", "XXX"], [3])
+        self.assertEqual(solve.parse_board(["CA", "T."], [3])[1], [3])
+
+
+class TestReadBoard(unittest.TestCase):
+
+    def read(self, text):
+        with tempfile.NamedTemporaryFile("w", delete=False) as f:
+            f.write(text)
+        self.addCleanup(os.remove, f.name)
+        return solve.read_board(f.name)
+
+    def test_blank_rows_inside_the_board_are_kept(self):
+        self.assertEqual(self.read("CA\n  \nT.\n\n3\n\n"),
+                         ([["C", "A"], [" ", " "], ["T", " "]], [3]))
+
+    def test_json_needs_board_and_lens(self):
+        for text in ('{"board": ["AB"]}', '{"lens": [2]}'):
+            with self.assertRaises(ValueError):
+                self.read(text)
+        self.assertEqual(self.read('{"board": ["AB"], "lens": [2]}'),
+                         ([["A", "B"]], [2]))
+
+
+class TestCovers(unittest.TestCase):
+
+    def test_every_cell_is_covered(self):
+        board = [list("CAT"), list("XXX")]
+        # CAT over the first row, and TAX ending in each cell of the second.
+        word_to_location = {
+            "CAT": [1 | 2 << 8 | 3 << 16],
+            "TAX": [3 | 2 << 8 | x << 16 for x in (4, 5, 6)]}
+        self.assertEqual(
+            list(solve.adaptive_covers(board, [3], word_to_location)), [])
+        self.assertEqual(
+            list(solve.dlx_covers(board, [3], word_to_location)), [])
+
+
+class TestCachedInput(unittest.TestCase):
+
+    def test_entry_of_another_shape_is_a_miss(self):
+        data = b"not really an image"
+        decoded = (BOARD, {(0, 0): (0, 0)}, [2, 2])
+        solve.parser_version()  # hashes the source of the real get_input
+        with tempfile.TemporaryDirectory() as cache:
+            entry = os.path.join(cache,
+                                 hashlib.sha256(data).hexdigest() + ".json")
+            for cached in ([1, 2], {"board": ["AB"]}, {"version": None}):
+                with open(entry, "w") as f:
+                    json.dump(cached, f)
+                with mock.patch("solve.get_input",
+                                return_value=decoded) as get_input:
+                    self.assertEqual(
+                        solve.get_cached_input(io.BytesIO(data), cache),
+                        decoded)
+                get_input.assert_called_once()
+
+
+class TestParseArgs(unittest.TestCase):
+
+    def test_limit_must_be_positive(self):
+        with self.assertRaises(SystemExit):
+            solve.parse_args(["IMG_01", "--limit", "0"])
+        self.assertEqual(solve.parse_args(["IMG_01", "--limit", "1"]).limit,
+                         1)
+
+    def test_count_rejects_what_it_cannot_do(self):
+        for extra in (["--solver", "dlx"], ["--workers", "2"],
+                      ["--check-unique"], ["--show", "sets"],
+                      ["--format", "binary"]):
+            with self.assertRaises(SystemExit):
+                with contextlib.redirect_stderr(io.StringIO()):
+                    solve.parse_args(["IMG_01", "--count"] + extra)
+
+
+if __name__ == '__main__':
+    unittest.main()